@@ -20,7 +20,7 @@ from .modules.scale_to_multiple_latent_size_picker import (
     ScaleToMultipleLatentSizePicker,
 )
 from .modules.tenc_weight_diff_check import TextEncoderDiffCheck
-from .modules.token_count_textbox import TokenCountTextBox
+from .modules.token_count_textbox import TokenBudgetTextBox, TokenCountTextBox
 from .modules.wait_node import WaitNode
 
 # to get the routes registered
@@ -49,6 +49,7 @@ NODE_CLASS_MAPPINGS = {
     "Ryuu_IsMultipleOf": IsMultipleOf,
     # Token Counter
     "Ryuu_TokenCountTextBox": TokenCountTextBox,
+    "Ryuu_TokenBudgetTextBox": TokenBudgetTextBox,
     # Experimental Nodes
     "Ryuu_TextEncoderDiffCheck": TextEncoderDiffCheck,
     "Ryuu_ExtractAndSaveLora": ExtractAndSaveLora,
@@ -71,6 +72,7 @@ NODE_DISPLAY_NAME_MAPPINGS = {  # maybe use 🍜 instead so colors clash less wi
     "Ryuu_ScaleToMultipleAdvanced": "Scale To Multiple Adv. 🐲",
     "Ryuu_ScaleToMultipleLatentSizePicker": "Latent Size Picker 🐲",
     "Ryuu_TokenCountTextBox": "Textbox 🐲",
+    "Ryuu_TokenBudgetTextBox": "Textbox Token Budget 🐲",
     # Experimental Nodes/Utils
     "Ryuu_TextEncoderDiffCheck": "Check Text Encoder Diff 🐲",
     "Ryuu_ExtractAndSaveLora": "Extract and Save Lora 🐲",
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Benchmarks the clamp quantile of the LoRA extraction (modules/shared/lora_decompose.py): scalable_quantile()
+against a reference on up/down weights sized like high-rank LoRAs of wide layers.
+Needs torch, ComfyUI itself is not needed.
+
+Below 2**24 values scalable_quantile() is torch.quantile() itself, those sizes only show that nothing changed there.
+torch.quantile refuses anything larger, for those scalable_quantile() uses torch.topk and a full torch.sort
+is the reference. Sizes are the number of values of the concatenated up and down weights, (out_dim + in_dim) * rank.
+
+Usage: python extras/bench_lora_quantile.py [--sizes 1000000 20000000 67108864] [--device cpu] [--repeat 3]
+"""
+import argparse
+import time
+
+from package_loader import load_package
+
+
+def timed(torch, func, repeat, device):
+    times = []
+    result = None
+    for _ in range(repeat):
+        if device.startswith("cuda"):
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        result = func()
+        if device.startswith("cuda"):
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def sorted_quantile(torch, values, q):
+    """torch.quantile's linear interpolation on a full sort, for sizes torch.quantile refuses"""
+    ordered = torch.sort(values).values
+    position = torch.tensor(q, dtype=values.dtype, device=values.device) * (values.numel() - 1)
+    below = int(position)
+    above = min(below + 1, values.numel() - 1)
+    return torch.lerp(ordered[below], ordered[above], position - below)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", nargs="+", type=int, default=[1_000_000, 16_000_000, 20_000_000, 64_000_000])
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--threads", type=int, default=0, help="torch threads, 0 = torch default")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    load_package()
+    import torch  # type: ignore
+
+    from ryuunoodles.modules.shared.lora_decompose import CLAMP_QUANTILE, scalable_quantile
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    generator = torch.Generator().manual_seed(args.seed)
+
+    print(f"quantile {CLAMP_QUANTILE}, device {args.device}, {torch.get_num_threads()} threads")
+    print(f"{'values':>12} | {'reference':>15} | {'ref s':>8} | {'new s':>8} | {'speedup':>7} | {'abs diff':>9}")
+    for size in args.sizes:
+        # heavy tailed like the scaled up weights, where the clamp actually matters
+        values = (torch.randn(size, generator=generator) * torch.rand(size, generator=generator).pow(4)).to(args.device)
+
+        if size < 2**24:
+            reference = "torch.quantile"
+            ref_time, expected = timed(torch, lambda: torch.quantile(values, CLAMP_QUANTILE), args.repeat, args.device)
+        else:
+            reference = "torch.sort"
+            ref_time, expected = timed(
+                torch, lambda: sorted_quantile(torch, values, CLAMP_QUANTILE), args.repeat, args.device
+            )
+        new_time, result = timed(torch, lambda: scalable_quantile(values, CLAMP_QUANTILE), args.repeat, args.device)
+
+        diff = (result - expected).abs().item()
+        print(f"{size:>12} | {reference:>15} | {ref_time:8.3f} | {new_time:8.3f} | "
+              f"{ref_time / new_time:6.1f}x | {diff:9.2e}")  # fmt: skip
+
+
+if __name__ == "__main__":
+    main()
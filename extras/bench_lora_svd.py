@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Benchmarks the SVD backends of the LoRA extraction (modules/shared/lora_decompose.py) on synthetic weight diffs
+shaped like FLUX/SDXL layers: time per layer and relative reconstruction error of full vs randomized SVD.
+Needs torch, ComfyUI itself is not needed.
+
+The diffs have a decaying spectrum plus noise, which is roughly what fine-tune diffs look like.
+The error of the full SVD is the best any rank-r decomposition can do.
+
+Usage: python extras/bench_lora_svd.py [--shapes 3072x3072 3072x12288] [--rank 32] [--oversample 10] [--power-iters 2]
+"""
+import argparse
+import time
+
+from package_loader import load_package
+
+
+def synthetic_diff(torch, out_dim, in_dim, generator, decay=0.05, noise=0.02):
+    k = min(out_dim, in_dim)
+    U, _ = torch.linalg.qr(torch.randn(out_dim, k, generator=generator))
+    V, _ = torch.linalg.qr(torch.randn(in_dim, k, generator=generator))
+    S = torch.exp(-decay * torch.arange(k, dtype=torch.float32))
+    return (U * S) @ V.T + noise * torch.randn(out_dim, in_dim, generator=generator) / k**0.5
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shapes", nargs="+", default=["3072x3072", "3072x12288", "12288x3072"])
+    parser.add_argument("--rank", type=int, default=32)
+    parser.add_argument("--oversample", type=int, default=10)
+    parser.add_argument("--power-iters", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--threads", type=int, default=0, help="torch threads, 0 = torch default")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    load_package()
+    import torch  # type: ignore
+
+    from ryuunoodles.modules.shared.lora_decompose import SVDBackend, extract_lora
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    generator = torch.Generator().manual_seed(args.seed)
+
+    print(f"rank {args.rank}, oversample {args.oversample}, power iterations {args.power_iters}, "
+          f"{torch.get_num_threads()} threads")  # fmt: skip
+    print(f"{'shape':>12} | {'full s':>8} | {'rand s':>8} | {'speedup':>7} | {'full err':>9} | {'rand err':>9}")
+    for shape in args.shapes:
+        out_dim, in_dim = (int(dim) for dim in shape.lower().split("x"))
+        diff = synthetic_diff(torch, out_dim, in_dim, generator)
+
+        results = {}
+        for backend in (SVDBackend.FULL, SVDBackend.RANDOMIZED):
+            times = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                _, _, error, _ = extract_lora(diff, args.rank, backend, args.oversample, args.power_iters)
+                times.append(time.perf_counter() - start)
+            results[backend] = (min(times), error)
+
+        (full_time, full_error), (rand_time, rand_error) = results[SVDBackend.FULL], results[SVDBackend.RANDOMIZED]
+        print(f"{shape:>12} | {full_time:8.3f} | {rand_time:8.3f} | {full_time / rand_time:6.1f}x | "
+              f"{full_error:9.5f} | {rand_error:9.5f}")  # fmt: skip
+
+
+if __name__ == "__main__":
+    main()
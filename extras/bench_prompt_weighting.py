@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Compares the old iterative regex strip_weighting with the single pass parser in modules/shared/prompt_weighting.py
+on generated nested prompts. Also checks that both give the exact same output.
+
+The second table uses a single very deeply nested tag, which is where the old O(n × depth) loop hurts the most.
+
+Usage: python extras/bench_prompt_weighting.py [--sizes 500 2000 8000] [--depth 6] [--deep 50 200 800] [--repeat 20]
+"""
+import argparse
+import random
+import re
+import timeit
+
+from package_loader import load_package
+
+
+# the implementation that used to live in pyserver/update_token_count.py
+def legacy_strip_weighting(text):
+    open_paren_placeholder = "\ue000"
+    close_paren_placeholder = "\ue001"
+
+    processed_text = []
+    escaped = False
+    for char in text:
+        if escaped:
+            if char == "(":
+                processed_text.append(open_paren_placeholder)
+            elif char == ")":
+                processed_text.append(close_paren_placeholder)
+            else:
+                processed_text.append("\\")
+                processed_text.append(char)
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        else:
+            processed_text.append(char)
+    if escaped:
+        processed_text.append("\\")
+    text = "".join(processed_text)
+
+    innermost_pattern = re.compile(r"\(([^()]*?)(?::[-+]?\d*(?:\.\d+)?)?\)")
+    previous_text = None
+    while text != previous_text:
+        previous_text = text
+        text = innermost_pattern.sub(r"\1", text)
+
+    text = text.replace(open_paren_placeholder, "(")
+    text = text.replace(close_paren_placeholder, ")")
+    return text
+
+
+WORDS = ["1girl", "solo", "masterpiece", "looking at viewer", "blue sky", "\\(artist\\)", "detailed", "smile"]
+
+
+def nested_tag(rng, depth):
+    tag = rng.choice(WORDS)
+    for _ in range(rng.randint(0, depth)):
+        if rng.random() < 0.5:
+            tag = f"({tag}:{rng.uniform(0.5, 1.5):.2f})"
+        else:
+            tag = f"({tag}, {rng.choice(WORDS)})"
+    return tag
+
+
+def generate_prompt(rng, size, depth):
+    tags = []
+    length = 0
+    while length < size:
+        tag = nested_tag(rng, depth)
+        tags.append(tag)
+        length += len(tag) + 2
+    return ", ".join(tags)
+
+
+def deep_prompt(depth):
+    return "1girl, " * 200 + "(" * depth + "word" + ":1.05)" * depth
+
+
+def bench(prompt_weighting, prompt, repeat, label):
+    if legacy_strip_weighting(prompt) != prompt_weighting.strip_weighting(prompt):
+        print(f"❌ Output mismatch for a {len(prompt)} char prompt")
+        exit(1)
+
+    legacy = timeit.timeit(lambda: legacy_strip_weighting(prompt), number=repeat) / repeat
+    new = timeit.timeit(lambda: prompt_weighting.strip_weighting(prompt), number=repeat) / repeat
+    print(f"{label:>8} {len(prompt):>8} {legacy * 1000:>10.3f} {new * 1000:>10.3f} {legacy / new:>7.1f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[500, 2000, 8000])
+    parser.add_argument("--depth", type=int, default=6)
+    parser.add_argument("--deep", type=int, nargs="+", default=[50, 200, 800])
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    load_package()
+    from ryuunoodles.modules.shared import prompt_weighting
+
+    rng = random.Random(args.seed)
+
+    print(f"{'depth':>8} {'chars':>8} {'legacy ms':>10} {'parser ms':>10} {'speedup':>8}")
+    for size in args.sizes:
+        bench(prompt_weighting, generate_prompt(rng, size, args.depth), args.repeat, f"<={args.depth}")
+    for depth in args.deep:
+        bench(prompt_weighting, deep_prompt(depth), args.repeat, str(depth))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Benchmarks the slow (python) tokenizers against their converted fast versions (pyserver/tokenizer_conversion.py):
+load time of the slow one, conversion time, load time of the stored tokenizer.json, parity and per request latency.
+Needs transformers and downloads the tokenizers on first run, ComfyUI itself is not needed.
+
+With transformers 5+ every tokenizer class is already fast, so there is nothing to convert and the keys are skipped.
+
+Usage: python extras/bench_tokenizer_fast_conversion.py [--tokenizers clip_l t5] [--prompts 200] [--repeat 5]
+"""
+import argparse
+import random
+import statistics
+import tempfile
+import time
+
+from package_loader import load_package
+
+
+TAGS = [
+    "1girl", "solo", "masterpiece", "best quality", "looking at viewer", "blue sky", "smile", "long hair",
+    "night, city lights", "from above", "(detailed background:1.2)", "score_9", "very aesthetic", "absurdres",
+    "an old man sitting on a bench in the park", "holding umbrella", "cowboy shot", "depth of field", "日本語",
+]  # fmt: skip
+
+
+def per_request_ms(tokenizer, prompts, repeat):
+    # like the count route: one prompt per call, no special tokens
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for prompt in prompts:
+            len(tokenizer(prompt, add_special_tokens=False)["input_ids"])
+        times.append((time.perf_counter() - start) / len(prompts))
+    return min(times) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokenizers", nargs="+", default=["clip_l", "t5"])
+    parser.add_argument("--prompts", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    load_package()
+    from ryuunoodles.pyserver.tokenizer_conversion import check_parity, convert_to_fast, load_converted
+    from ryuunoodles.pyserver.tokenizer_loader import _TOKENIZER_SPECS, _spec_id, resolve_key
+
+    rng = random.Random(args.seed)
+    prompts = [", ".join(rng.choice(TAGS) for _ in range(rng.randint(5, 60))) for _ in range(args.prompts)]
+
+    with tempfile.TemporaryDirectory() as root:
+        for name in args.tokenizers:
+            key = resolve_key(name)
+            if key not in _TOKENIZER_SPECS:
+                print(f"❌ {name}: unknown tokenizer")
+                continue
+            tokenizer_cls, repo_id, kwargs, log_name = _TOKENIZER_SPECS[key]
+
+            start = time.perf_counter()
+            slow = tokenizer_cls.from_pretrained(repo_id, **kwargs)
+            slow_load = time.perf_counter() - start
+            if slow.is_fast:
+                print(f"➖ {log_name}: {type(slow).__name__} is already fast, nothing to convert\n")
+                continue
+
+            start = time.perf_counter()
+            fast = convert_to_fast(slow, root, _spec_id(key))
+            convert_time = time.perf_counter() - start
+            if fast is None:
+                print(f"❌ {log_name}: converted tokenizer doesn't match the slow one (or conversion failed)\n")
+                continue
+
+            start = time.perf_counter()
+            reloaded, _ = load_converted(root, _spec_id(key))
+            reload_time = time.perf_counter() - start
+
+            # parity on the benchmark prompts too, not just the built-in texts
+            mismatch = check_parity(slow, reloaded, prompts)
+            slow_ms = per_request_ms(slow, prompts, args.repeat)
+            fast_ms = per_request_ms(reloaded, prompts, args.repeat)
+            tokens = statistics.mean(len(ids) for ids in reloaded(prompts, add_special_tokens=False)["input_ids"])
+
+            print(f"{'✅' if mismatch is None else '❌'} {log_name} ({type(slow).__name__}), ~{tokens:.0f} tokens/prompt")
+            print(f"   load: slow {slow_load:.2f}s | convert {convert_time:.2f}s | stored fast {reload_time:.2f}s")
+            print(f"   per request: slow {slow_ms:.3f}ms | fast {fast_ms:.3f}ms | {slow_ms / fast_ms:.1f}x")
+            if mismatch is not None:
+                print(f"   differs on: {mismatch!r}")
+            print()
+
+
+if __name__ == "__main__":
+    main()
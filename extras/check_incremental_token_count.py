@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Checks incremental token counting (pyserver/incremental_token_count.py) against a full tokenization
+for every tokenizer get_tokenizer() knows about, over a sequence of random tag edits.
+Needs transformers and downloads the tokenizers on first run, ComfyUI itself is not needed.
+
+Usage: python extras/check_incremental_token_count.py [--steps 300] [--tokenizers clip_l t5 ...]
+"""
+import argparse
+import random
+
+from package_loader import load_package
+
+
+TAGS = [
+    "1girl", "solo", "masterpiece", "best quality", "looking at viewer", "blue sky", "smile", "long hair",
+    "BREAK", "night, city lights", "from above", "(detailed)", "an old man sitting on a bench", "日本語", "x,y",
+    "score_9", "very aesthetic", "\n",
+]  # fmt: skip
+
+
+def random_edit(rng, tags):
+    op = rng.random()
+    i = rng.randrange(len(tags) + 1)
+    if op < 0.25 and tags:
+        tags.pop(min(i, len(tags) - 1))
+    elif op < 0.5:
+        tags.insert(i, rng.choice(TAGS))
+    elif tags:
+        # typing into a tag one char at a time is the common case
+        j = min(i, len(tags) - 1)
+        tags[j] += rng.choice("abcdefg ,.-")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--steps", type=int, default=300)
+    parser.add_argument("--tags", type=int, default=60)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--tokenizers", nargs="+", default=None)
+    args = parser.parse_args()
+
+    load_package()
+    from ryuunoodles.pyserver.incremental_token_count import IncrementalTokenCounter
+    from ryuunoodles.pyserver.tokenizer_loader import TOKENIZER_KEYS, get_tokenizer
+
+    failed = False
+    for key in args.tokenizers or TOKENIZER_KEYS:
+        tokenizer = get_tokenizer(key)
+        if tokenizer is None:
+            print(f"❌ {key}: unknown tokenizer")
+            failed = True
+            continue
+
+        def full_count(text):
+            return len(tokenizer(text, add_special_tokens=False)["input_ids"])
+
+        rng = random.Random(args.seed)
+        # resync disabled so drift from a wrong boundary reconciliation can't hide
+        counter = IncrementalTokenCounter(resync_every=0)
+        tags = [rng.choice(TAGS) for _ in range(args.tags)]
+        mismatches = 0
+        for step in range(args.steps):
+            random_edit(rng, tags)
+            text = ", ".join(tags)
+            expected = full_count(text)
+            got = counter.count(("check", key), text, full_count)
+            if got != expected:
+                mismatches += 1
+                if mismatches == 1:
+                    print(f"   first mismatch at step {step}: incremental={got} full={expected}")
+                # start over from the real count so one error doesn't show up as many
+                counter = IncrementalTokenCounter(resync_every=0)
+
+        status = "✅" if mismatches == 0 else "❌"
+        print(f"{status} {key}: {mismatches}/{args.steps} mismatches")
+        failed = failed or mismatches > 0
+
+    exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Measures how far the cold start estimates (pyserver/token_estimate.py) are off from the real token counts,
+with the per family rules only and with a vocab snapshot, plus how long an estimate takes.
+Needs transformers and downloads the tokenizers on first run, ComfyUI itself is not needed.
+
+Usage: python extras/measure_token_estimate_error.py [--prompts 200] [--corpus prompts.txt] [--tokenizers clip_l t5 ...]
+"""
+import argparse
+import random
+import tempfile
+import time
+from pathlib import Path
+
+from package_loader import load_package
+
+
+TAGS = [
+    "1girl", "solo", "masterpiece", "best quality", "looking at viewer", "blue sky", "smile", "long hair",
+    "night, city lights", "from above", "detailed background", "score_9", "very aesthetic", "absurdres",
+    "hatsune miku", "holding umbrella", "cowboy shot", "depth of field", "2024", "日本語", "highres",
+]  # fmt: skip
+
+SENTENCES = [
+    "A photograph of an astronaut riding a horse on the surface of the moon.",
+    "An old man sitting on a bench in a park, autumn leaves falling around him, soft evening light.",
+    "Close-up portrait of a cat wearing tiny glasses, reading a newspaper, studio lighting, 85mm lens.",
+    "The city skyline at night, reflected in the river, long exposure, neon signs in Japanese and English.",
+]  # fmt: skip
+
+
+def build_corpus(rng, amount):
+    corpus = []
+    for _ in range(amount):
+        if rng.random() < 0.7:
+            corpus.append(", ".join(rng.choice(TAGS) for _ in range(rng.randint(3, 40))))
+        else:
+            corpus.append(" ".join(rng.choice(SENTENCES) for _ in range(rng.randint(1, 4))))
+    return corpus
+
+
+def measure(estimator, key, corpus, real_counts):
+    errors = []
+    start = time.perf_counter()
+    for text, real in zip(corpus, real_counts):
+        errors.append(estimator.estimate(key, text)["count"] - real)
+    elapsed = (time.perf_counter() - start) / len(corpus)
+
+    relative = [abs(error) / max(real, 1) for error, real in zip(errors, real_counts)]
+    return {
+        "mean_abs": sum(abs(error) for error in errors) / len(errors),
+        "mean_rel": sum(relative) / len(relative),
+        "max_abs": max(abs(error) for error in errors),
+        "bias": sum(errors) / len(errors),
+        "ms": elapsed * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--prompts", type=int, default=200)
+    parser.add_argument("--corpus", type=str, default=None, help="text file with one prompt per line")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--tokenizers", nargs="+", default=None)
+    args = parser.parse_args()
+
+    load_package()
+    from ryuunoodles.pyserver.token_estimate import TokenEstimator
+    from ryuunoodles.pyserver.tokenizer_loader import TOKENIZER_KEYS, get_tokenizer
+
+    if args.corpus:
+        corpus = [line.strip() for line in Path(args.corpus).read_text(encoding="utf-8").splitlines() if line.strip()]
+    else:
+        corpus = build_corpus(random.Random(args.seed), args.prompts)
+
+    with tempfile.TemporaryDirectory() as snapshot_dir:
+        rules_only = TokenEstimator()
+        with_snapshot = TokenEstimator(snapshot_dir)
+
+        print(f"{len(corpus)} prompts, error = estimate - real count (without special tokens)\n")
+        print(f"{'tokenizer':<10} {'mode':<9} {'mean abs':>9} {'mean %':>8} {'max abs':>8} {'bias':>7} {'ms/est':>7}")
+        for key in args.tokenizers or TOKENIZER_KEYS:
+            tokenizer = get_tokenizer(key)
+            if tokenizer is None:
+                print(f"{key:<10} unknown tokenizer")
+                continue
+            real_counts = [len(ids) for ids in tokenizer(corpus, add_special_tokens=False)["input_ids"]]
+            with_snapshot.save_snapshot(key, tokenizer)
+
+            for mode, estimator in (("rules", rules_only), ("snapshot", with_snapshot)):
+                r = measure(estimator, key, corpus, real_counts)
+                print(
+                    f"{key:<10} {mode:<9} {r['mean_abs']:>9.2f} {r['mean_rel'] * 100:>7.1f}% "
+                    f"{r['max_abs']:>8} {r['bias']:>+7.2f} {r['ms']:>7.3f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,13 @@
+"""Shared by the scripts in extras/, they run from a plain checkout without ComfyUI."""
+import importlib.util
+import sys
+from pathlib import Path
+
+
+def load_package():
+    # register the repo as a package without running its __init__.py (which needs ComfyUI)
+    root = Path(__file__).resolve().parent.parent
+    spec = importlib.util.spec_from_loader("ryuunoodles", loader=None, is_package=True)
+    package = importlib.util.module_from_spec(spec)
+    package.__path__ = [str(root)]
+    sys.modules["ryuunoodles"] = package
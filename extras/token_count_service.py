@@ -0,0 +1,16 @@
+#!/usr/bin/env python3
+"""
+Runs the token counter as a standalone service, ComfyUI itself is not needed. Point ComfyUI at it with
+RYUU_TOKENCOUNT_SERVICE=http://127.0.0.1:8190 (or unix:/path/to.sock) and it forwards all token counting there,
+so several ComfyUI instances on one host only load the tokenizers once.
+
+Usage: python extras/token_count_service.py [--host 127.0.0.1] [--port 8190] [--unix /path/to.sock] [--data-dir DIR]
+"""
+from package_loader import load_package
+
+
+if __name__ == "__main__":
+    load_package()
+    from ryuunoodles.pyserver.token_count_service import main
+
+    main()
@@ -54,12 +54,13 @@ app.registerExtension({
             name: "Update Interval in ms",
             type: "slider",
             attrs: {
-                min: 100,
+                min: 50,
                 max: 2500,
                 step: 25,
             },
             defaultValue: 1000,
-            tooltip: "Default: 1000\nSuggested to stay above 200ms.",
+            tooltip: "Default: 1000\nCounts are sent over a websocket and outdated ones are dropped by the server, " +
+                "so going down to ~100ms is fine.",
             onChange: (newVal, oldVal) => {
                 console.log(`RyuuSettings.TokenizerAddSpecialTokens.UpdateInterval has been changed from ${oldVal} to ${newVal}`);
             },
@@ -8,7 +8,7 @@ const compactNames = {
     qwen25vl: "Q2.5VL",
     auraflow: "AF",
 };
-// todo: move this to some config file maybe? related todo in pyserver file
+// todo: move this to some config file maybe? custom tokenizers from the pyserver config just use their key
 
 function isTokenCounterEnabled() {
     return app.extensionManager.setting.get("RyuuSettings.TokenCountOverlay.Enabled") !== false;
@@ -52,47 +52,277 @@ function prettifyTokenizerName(tok, compactMode) {
     return hasFast ? `${title}🚀` : title;
 }
 
-async function updateTokenCount(node) {
-    // Don't do anything if disabled
-    if (!isTokenCounterEnabled()) return;
+// Ask the server which tokenizers are still loading, so the overlay can show that instead of looking stuck
+async function fetchTokenizerStates(node) {
+    try {
+        const resp = await api.fetchApi("/ryuu/tokenizers/status");
+        const data = await resp.json();
+        const aliases = data.aliases || {};
+        node._tokenizerStates = Object.fromEntries(
+            Object.entries(data.tokenizers || {}).map(([tok, status]) => [tok, status.state])
+        );
+        // states are keyed by the resolved tokenizer key, the node's tok_types can be any spelling or alias of it
+        for (const [alias, tok] of Object.entries(aliases)) {
+            if (tok in node._tokenizerStates) node._tokenizerStates[alias] = node._tokenizerStates[tok];
+        }
+    } catch (e) {
+        node._tokenizerStates = {};
+    }
+    // the count may have arrived in the meantime
+    if (!node._countPending) node._tokenizerStates = {};
+    node.setDirtyCanvas?.(true);
+}
+
+// region: websocket
+// One socket shared by all nodes. The server cancels work for a node once a newer text for it arrives
+// and only pushes the latest counts back, so the update interval can be lower without flooding it with requests.
+const tokenCountSocket = {
+    ws: null,
+    pending: new Map(), // node_key -> { seq, resolve }
+    seq: 0,
+    lastAttempt: 0,
+};
 
+function getTokenCountSocket() {
+    const ws = tokenCountSocket.ws;
+    if (ws && ws.readyState === WebSocket.OPEN) return ws;
+
+    // (re)connect in the background, at most every 5s, HTTP is used until then
+    if (!ws && Date.now() - tokenCountSocket.lastAttempt > 5000) {
+        tokenCountSocket.lastAttempt = Date.now();
+        try {
+            const url = new URL(api.apiURL("/ryuu/token_count_ws"), window.location.href);
+            url.protocol = url.protocol === "https:" ? "wss:" : "ws:";
+            const socket = new WebSocket(url);
+            socket.onmessage = (event) => {
+                const data = JSON.parse(event.data);
+                if (!data.id && data.error) {
+                    // an error the server couldn't tie to a request, nothing should wait for a reply forever
+                    for (const pending of tokenCountSocket.pending.values()) pending.resolve(data);
+                    tokenCountSocket.pending.clear();
+                    return;
+                }
+                const pending = tokenCountSocket.pending.get(data.id);
+                if (!pending || pending.seq !== data.seq) return; // stale
+                tokenCountSocket.pending.delete(data.id);
+                pending.resolve(data);
+            };
+            socket.onclose = () => {
+                // whatever is still waiting goes through HTTP instead
+                for (const pending of tokenCountSocket.pending.values()) pending.resolve(null);
+                tokenCountSocket.pending.clear();
+                tokenCountSocket.ws = null;
+            };
+            tokenCountSocket.ws = socket;
+        } catch (e) {
+            console.warn("[RyuuNoodles TokenCounterOverlay] Could not open token count websocket:", e);
+        }
+    }
+    return null;
+}
+
+// Resolves with the response data, null if the socket isn't usable or undefined if superseded by a newer request
+function requestCountsOverSocket(payload) {
+    const ws = getTokenCountSocket();
+    if (!ws) return Promise.resolve(null);
+
+    const id = payload.node_key;
+    const seq = ++tokenCountSocket.seq;
+    return new Promise(resolve => {
+        tokenCountSocket.pending.get(id)?.resolve(undefined);
+        tokenCountSocket.pending.set(id, { seq, resolve });
+        // id and seq first, the server can still answer frames it won't parse (too large) by reading just those
+        ws.send(JSON.stringify({ id, seq, ...payload }));
+    });
+}
+// endregion: websocket
+
+// Builds the request body for a node, null if there's nothing (new) to count
+function buildCountPayload(node) {
     const rawSettingsString = app.extensionManager.setting.get("RyuuSettings.TokenCountOverlay") || "";
     const addSpecialTokens = app.extensionManager.setting.get("RyuuSettings.TokenizerAddSpecialTokens") || false;
     const SupportBreakKeyword = app.extensionManager.setting.get("RyuuSettings.TokenCountOverlay.SupportBreakKeyword") || false;
     const mapping = parseSettingsString(rawSettingsString);
     const mapConfig = mapping[node._mapConfigName];
 
-    if (!mapConfig) return;
+    if (!mapConfig) return null;
 
     const widget = node.widgets.find(w => w.name === mapConfig.widget);
-    if (!widget) return;
+    if (!widget) return null;
 
     const inputText = (widget.value ?? "") + "";
 
     // skip if text unchanged
-    if (inputText === node._lastText) return;
+    if (inputText === node._lastText) return null;
 
     node._lastText = inputText;
 
+    return {
+        text: inputText,
+        tok_types: mapConfig.tok_types,
+        add_special_tokens: addSpecialTokens,
+        support_break_keyword: SupportBreakKeyword,
+        // lets the server only re-tokenize the parts of the text that changed since the last request
+        node_key: `${api.clientId ?? ""}:${node.id}`,
+    };
+}
+
+// Stores the counts from a response on the node.
+// Counts the server only estimated (tokenizer still loading) are asked for again until the real ones arrive
+function applyCounts(node, data) {
+    clearTimeout(node._recountTimer);
+    node._recountTimer = null;
+
+    // throttled (too many requests from this client at once), keep the old counts and back off before trying again
+    if (data.retry_after) {
+        node._retryDelay = Math.min((node._retryDelay || 500) * 2, 10000);
+        node._recountTimer = setTimeout(() => {
+            node._lastText = "";
+            updateTokenCount(node);
+        }, Math.max(data.retry_after * 1000, node._retryDelay));
+        return;
+    }
+    node._retryDelay = 0;
+
+    node._tokenCounts = data.token_counts || {};
+    node._tokenChunks = data.chunks || {};
+    node._tokenApprox = data.approximate || {};
+    // e.g. text too long, shown instead of the counts until the text changes
+    node._tokenLimit = data.limit ? data.error : null;
+
+    if (Object.keys(node._tokenApprox).length) {
+        node._recountTimer = setTimeout(() => {
+            node._lastText = "";
+            updateTokenCount(node);
+        }, 1000);
+    }
+}
+
+// region: batch
+// Nodes enabled at the same time (workflow load, toggling the overlay) are counted with one batch request
+const batchQueue = new Set();
+let batchTimer = null;
+
+function queueBatchCount(node) {
+    batchQueue.add(node);
+    if (!batchTimer) batchTimer = setTimeout(flushBatchCount, 50);
+}
+
+// well below the server's default RYUU_TOKENCOUNT_MAX_BATCH_ITEMS / RYUU_TOKENCOUNT_MAX_BODY_BYTES
+const BATCH_MAX_ITEMS = 64;
+const BATCH_MAX_CHARS = 1024 * 1024;
+
+function chunkBatchItems(items) {
+    const chunks = [];
+    let chunk = [];
+    let chars = 0;
+    for (const item of items) {
+        const size = JSON.stringify(item).length;
+        if (chunk.length && (chunk.length >= BATCH_MAX_ITEMS || chars + size > BATCH_MAX_CHARS)) {
+            chunks.push(chunk);
+            chunk = [];
+            chars = 0;
+        }
+        chunk.push(item);
+        chars += size;
+    }
+    if (chunk.length) chunks.push(chunk);
+    return chunks;
+}
+
+function countEach(nodes) {
+    for (const node of nodes) {
+        node._lastText = "";
+        updateTokenCount(node);
+    }
+}
+
+async function flushBatchCount() {
+    batchTimer = null;
+    if (!isTokenCounterEnabled()) {
+        batchQueue.clear();
+        return;
+    }
+
+    const nodes = new Map(); // node_key -> node
+    const items = [];
+    for (const node of batchQueue) {
+        const payload = buildCountPayload(node);
+        if (!payload) continue;
+        nodes.set(payload.node_key, node);
+        items.push({ ...payload, id: payload.node_key });
+    }
+    batchQueue.clear();
+
+    // one after the other, so a big workflow doesn't use up the server's per client limit on its own
+    for (const chunk of chunkBatchItems(items)) {
+        await sendBatchCount(chunk, nodes);
+    }
+}
+
+async function sendBatchCount(items, nodes) {
+    const ids = items.map((item) => item.id);
     try {
-        const resp = await api.fetchApi("/ryuu/update_token_count", {
+        const resp = await api.fetchApi("/ryuu/update_token_count_batch", {
             method: "POST",
             headers: { "Content-Type": "application/json" },
-            body: JSON.stringify({
-                text: inputText,
-                tok_types: mapConfig.tok_types,
-                add_special_tokens: addSpecialTokens,
-                support_break_keyword: SupportBreakKeyword,
-            }),
+            body: JSON.stringify({ items }),
         });
-
         const data = await resp.json();
-        node._tokenCounts = data.token_counts || {};
+        if (data.limit && data.retry_after == null) {
+            // the batch itself was turned away (too many items, too large), that's no reason to not count the nodes
+            countEach(ids.map((id) => nodes.get(id)));
+            return;
+        }
+        for (const id of ids) {
+            const node = nodes.get(id);
+            // a throttled batch as a whole has no results, every node backs off then
+            applyCounts(node, data.results?.[id] || data);
+            node.setDirtyCanvas?.(true);
+        }
+    } catch (e) {
+        console.error("[RyuuNoodles TokenCounterOverlay] Batch error:", e);
+        // count them one by one instead
+        countEach(ids.map((id) => nodes.get(id)));
+    }
+}
+// endregion: batch
+
+async function updateTokenCount(node) {
+    // Don't do anything if disabled
+    if (!isTokenCounterEnabled()) return;
+
+    const payload = buildCountPayload(node);
+    if (!payload) return;
+
+    // a slow response usually means a tokenizer is being loaded (cold start)
+    node._countPending = true;
+    const statusTimer = setTimeout(() => fetchTokenizerStates(node), 400);
+
+    try {
+        let data = await requestCountsOverSocket(payload);
+        // superseded by a newer text for this node, that request updates the overlay
+        if (data === undefined) return;
+
+        if (data === null) {
+            // socket not available, plain HTTP it is
+            const resp = await api.fetchApi("/ryuu/update_token_count", {
+                method: "POST",
+                headers: { "Content-Type": "application/json" },
+                body: JSON.stringify(payload),
+            });
+            data = await resp.json();
+        }
+        applyCounts(node, data);
     } catch (e) {
         console.error("[RyuuNoodles TokenCounterOverlay] Error:", e);
-        node._tokenCounts = {};
+        applyCounts(node, {});
+    } finally {
+        clearTimeout(statusTimer);
     }
 
+    node._countPending = false;
+    node._tokenizerStates = {};
     node.setDirtyCanvas?.(true);
 }
 
@@ -148,8 +378,8 @@ function enableCounting(node) {
         }
     };
 
-    // Force initial update
-    updateTokenCount(node);
+    // Force initial update, batched with every other node enabled around the same time
+    queueBatchCount(node);
 }
 
 // Disable token counting
@@ -159,9 +389,12 @@ function disableCounting(node) {
         clearTimeout(node._updateTimeout);
         node._updateTimeout = null;
     }
+    clearTimeout(node._recountTimer);
+    node._recountTimer = null;
 
     // Clear token counts to hide display
     node._tokenCounts = {};
+    node._tokenLimit = null;
 
     // Restore original widget callback if there's one
     if (node._originalWidgetCallback) {
@@ -232,10 +465,17 @@ async function registerTokenCountNode(nodeType, nodeData) {
         // build "Clip L Tokens: 0 | T5🚀 Tokens: 0 | Chars: 0"
         const compactMode = app.extensionManager.setting.get("RyuuSettings.TokenCountOverlay.CompactMode") === true;
         const parts = nodeWidgetMappingConfig.tok_types.map(tt => {
-            const cnt = this._tokenCounts?.[tt] || 0;
+            // an estimate is better than nothing while the tokenizer loads
+            const approx = this._tokenApprox?.[tt];
+            const warmingUp = !approx && this._tokenizerStates?.[tt.toLowerCase().trim()] === "loading";
+            const cnt = warmingUp ? (compactMode ? "⏳" : "warming up…") : `${approx ? "~" : ""}${this._tokenCounts?.[tt] || 0}`;
             const tokenLabel = compactMode ? "" : " Tokens";
-            return `${prettifyTokenizerName(tt, compactMode)}${tokenLabel}: ${cnt}`;
+            // number of 75-token CLIP chunks when BREAK support is on
+            const chunks = this._tokenChunks?.[tt];
+            const chunkLabel = !warmingUp && chunks?.length > 1 ? ` (${chunks.length}×75)` : "";
+            return `${prettifyTokenizerName(tt, compactMode)}${tokenLabel}: ${cnt}${chunkLabel}`;
         });
+        if (this._tokenLimit) parts.splice(0, parts.length, this._tokenLimit);
         parts.push(`${compactMode ? "C" : "Chars"}: ${(this._lastText || "").length}`);
         const txt = parts.join(" | ");
 
@@ -1,5 +1,7 @@
 import re
 
+from ..modules.shared.prompt_weighting import strip_weighting
+
 # todo: second textbox that updates on input_text change to work with token counter maybe?
 
 
@@ -95,7 +97,19 @@ class CleanStringAdvanced:
                         ),
                     },
                 ),
-            }
+            },
+            "optional": {
+                "remove_weighting": (
+                    "BOOLEAN",
+                    {
+                        "default": False,
+                        "tooltip": (
+                            "Remove prompt weighting syntax before any other cleaning is done.\n"
+                            "Example: '((apple:1.2), banana:0.8), \\(orange\\)' → 'apple, banana, (orange)'\n"
+                        ),
+                    },
+                ),
+            },
         }
 
     CATEGORY = "RyuuNoodles 🐲/Text"
@@ -111,6 +125,7 @@ class CleanStringAdvanced:
         "- Collapse multiple spaces in the input string\n"
         "- Convert to lowercase/uppercase and more\n"
         "- Control newline handling (off/remove empty/collapse lines)\n"
+        "- Remove prompt weighting syntax like (word:1.2)\n"
         "\n"
         "Useful for normalizing input strings for consistent processing."
     )
@@ -213,7 +228,12 @@ class CleanStringAdvanced:
         newlines,
         collapse,
         remove_duplicate_tags,
+        remove_weighting=False,
     ):
+        # Remove weighting first so the leftover spaces/commas get cleaned up too
+        if remove_weighting:
+            input_text = strip_weighting(input_text)
+
         # Split into lines for newline handling
         lines = input_text.splitlines()
 
@@ -1,17 +1,21 @@
 import json
 import os
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
 from enum import Enum
 
-import torch  # type: ignore
-
+import comfy.lora  # type: ignore
 import comfy.model_management  # type: ignore
-import comfy.utils  # type: ignore
 import folder_paths  # type: ignore
+import torch  # type: ignore
 from comfy.cli_args import args  # type: ignore
 
+from ..modules.shared.lora_decompose import SVD_BACKENDS, SVDBackend, extract_lora_batch_ranks, plan_batches
 from ..modules.shared.ryuu_log import ryuu_log
-
-CLAMP_QUANTILE = 0.99
+from ..modules.shared.safetensors_writer import SafetensorsStreamWriter
 
 
 class LORAType(Enum):
@@ -22,35 +26,17 @@ class LORAType(Enum):
 LORA_TYPES = {"standard": LORAType.STANDARD, "full_diff": LORAType.FULL_DIFF}
 
 
-def extract_lora(diff, rank):
-    conv2d = len(diff.shape) == 4
-    kernel_size = None if not conv2d else diff.size()[2:4]
-    conv2d_3x3 = conv2d and kernel_size != (1, 1)
-    out_dim, in_dim = diff.size()[0:2]
-    rank = min(rank, in_dim, out_dim)
-
-    if conv2d:
-        if conv2d_3x3:
-            diff = diff.flatten(start_dim=1)
-        else:
-            diff = diff.squeeze()
-
-    U, S, Vh = torch.linalg.svd(diff.float())
-    U = U[:, :rank]
-    S = S[:rank]
-    U = U @ torch.diag(S)
-    Vh = Vh[:rank, :]
-
-    dist = torch.cat([U.flatten(), Vh.flatten()])
-    hi_val = torch.quantile(dist, CLAMP_QUANTILE)
-    low_val = -hi_val
-
-    U = U.clamp(low_val, hi_val)
-    Vh = Vh.clamp(low_val, hi_val)
-    if conv2d:
-        U = U.reshape(out_dim, rank, 1, 1)
-        Vh = Vh.reshape(rank, in_dim, kernel_size[0], kernel_size[1])
-    return (U, Vh)
+def _parse_ranks(rank, extra_ranks):
+    """rank plus the comma separated extra_ranks, sorted and without duplicates"""
+    ranks = {rank}
+    for item in extra_ranks.replace(";", ",").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        if not item.isdigit() or not 1 <= int(item) <= 4096:
+            raise ValueError(f"[Extract and Save LoRA] Invalid rank '{item}' in extra_ranks, expected 1-4096")
+        ranks.add(int(item))
+    return sorted(ranks)
 
 
 def _check_text_encoder_diff(text_encoder_diff):
@@ -75,39 +61,194 @@ def _check_text_encoder_diff(text_encoder_diff):
     return any_diff_zero, text_proj_zero
 
 
-def calc_lora_model(model_diff, rank, prefix_model, prefix_lora, output_sd, lora_type, bias_diff=False):
-    comfy.model_management.load_models_gpu([model_diff], force_patch_weights=True)
-    sd = model_diff.model_state_dict(filter_prefix=prefix_model)
+def _log_svd_errors(errors, svd_backend, elapsed, rank):
+    """errors: [(key, error, full_error or None)] from extract_lora"""
+    if not errors:
+        return
+    mean_error = sum(error for _, error, _ in errors) / len(errors)
+    worst_key, worst_error, _ = max(errors, key=lambda item: item[1])
+    ryuu_log(
+        f"[Extract and Save LoRA] {svd_backend.name.lower()} SVD of {len(errors)} layers took {elapsed:.1f}s, "
+        f"rank {rank} relative reconstruction error mean {mean_error:.4f}, max {worst_error:.4f} ({worst_key})"
+    )
+    checked = [(key, error - full_error) for key, error, full_error in errors if full_error is not None]
+    if checked:
+        excess_key, max_excess = max(checked, key=lambda item: item[1])
+        mean_excess = sum(excess for _, excess in checked) / len(checked)
+        ryuu_log(
+            f"[Extract and Save LoRA] Compared to the full SVD: mean excess error {mean_excess:.5f}, "
+            f"max {max_excess:.5f} ({excess_key})"
+        )
+
+
+def _extract_batch(keys, sd, ranks, svd_options):
+    """
+    extract_lora_batch_ranks() for keys with up/down already as contiguous fp16 on the CPU,
+    layers of a batch that fails are retried one by one. Returns {key: {rank: result}}.
+    """
+    # seeded by the layer, not by the order the batches happen to run in
+    seed = zlib.crc32(keys[0].encode())
+    try:
+        results = extract_lora_batch_ranks([sd[k] for k in keys], ranks, seed=seed, **svd_options)
+        return {
+            k: {
+                rank: (up.contiguous().half().cpu(), down.contiguous().half().cpu(), error, full_error)
+                for rank, (up, down, error, full_error) in by_rank.items()
+            }
+            for k, by_rank in zip(keys, results)
+        }
+    except Exception:
+        if len(keys) == 1:
+            ryuu_log(
+                f"[Extract and Save LoRA] Could not generate lora weights for key {keys[0]}, "
+                "is the weight difference a zero?"
+            )
+            return {}
+    results = {}
+    for k in keys:
+        results.update(_extract_batch([k], sd, ranks, svd_options))
+    return results
+
+
+class _LayerDiffs:
+    """
+    Read-only {key: diff} of a ModelSubtract/CLIPSubtract patcher that patches a single weight when it's looked up,
+    the way ModelPatcher.patch_weight_to_device() would but into a float32 copy on device. The model itself is never
+    loaded or patched, so only the layers being decomposed right now take up memory.
+    """
 
-    for k in sd:
+    def __init__(self, model_patcher, prefix, device):
+        self._patcher = model_patcher
+        self._weights = model_patcher.model_state_dict(filter_prefix=prefix)
+        self._device = device
+
+    def __getitem__(self, key):
+        backup = self._patcher.backup.get(key)
+        # the original weight if the model happens to be patched already
+        weight = backup.weight if backup is not None else self._weights[key]
+        diff = comfy.model_management.cast_to_device(weight, self._device, torch.float32, copy=True)
+        patches = self._patcher.patches.get(key)
+        if not patches:
+            return diff
+        calculate_weight = getattr(comfy.lora, "calculate_weight", None) or self._patcher.calculate_weight
+        return calculate_weight(patches, diff, key)
+
+
+@contextmanager
+def _torch_threads(threads):
+    """Limits torch's intra-op threads (BLAS/LAPACK included) while extracting."""
+    previous = torch.get_num_threads()
+    torch.set_num_threads(threads)
+    try:
+        yield
+    finally:
+        torch.set_num_threads(previous)
+
+
+def _run_batches(batches, sd, ranks, svd_options, workers, threads_per_worker):
+    """
+    Yields (key, result) of every batch in the order of batches, however many workers run them.
+    Every batch is seeded and decomposed on its own with the same number of threads, so the results don't depend on
+    the number of workers (BLAS/LAPACK results can depend on the thread count, so that one is never derived from it).
+    torch's heavy ops release the GIL, so worker threads run their SVDs in parallel.
+    """
+    threads = threads_per_worker or torch.get_num_threads()
+    if workers > 1 and len(batches) > 1:
+        if not threads_per_worker and workers * threads > (os.cpu_count() or 1):
+            ryuu_log(
+                f"[Extract and Save LoRA] {workers} workers with {threads} threads each oversubscribe the CPU, "
+                f"set threads_per_worker to about {max(1, (os.cpu_count() or 1) // workers)}",
+                loglevel="warning",
+            )
+        pool = ThreadPoolExecutor(
+            max_workers=workers,
+            thread_name_prefix="ryuu_extract_lora",
+            initializer=torch.set_num_threads,  # some BLAS builds keep the thread count per thread
+            initargs=(threads,),
+        )
+        with _torch_threads(threads), pool:
+            # results are handed out in submission order, only a few batches ahead of the one being written
+            pending = deque()
+            for batch in batches:
+                pending.append(pool.submit(_extract_batch, batch, sd, ranks, svd_options))
+                if len(pending) >= 2 * workers:
+                    yield from pending.popleft().result().items()
+            while pending:
+                yield from pending.popleft().result().items()
+        return
+
+    with _torch_threads(threads):
+        for batch in batches:
+            yield from _extract_batch(batch, sd, ranks, svd_options).items()
+
+
+def calc_lora_model(
+    model_diff,
+    ranks,
+    prefix_model,
+    prefix_lora,
+    output_sds,
+    lora_type,
+    bias_diff=False,
+    svd_backend=SVDBackend.FULL,
+    oversample=10,
+    power_iters=2,
+    check_error=False,
+    svd_batch_bytes=0,
+    workers=1,
+    threads_per_worker=0,
+    layer_by_layer=False,
+):
+    """
+    Writes the LoRA of model_diff for every rank in ranks into output_sds[rank] (a state dict or writer),
+    each layer is decomposed only once for all of them. Tensors that don't depend on the rank go into every one.
+    """
+    if layer_by_layer:
+        # diffs are only computed when they're needed, weights has the unpatched ones for their shapes
+        weights = model_diff.model_state_dict(filter_prefix=prefix_model)
+        sd = _LayerDiffs(model_diff, prefix_model, model_diff.load_device)
+    else:
+        comfy.model_management.load_models_gpu([model_diff], force_patch_weights=True)
+        sd = weights = model_diff.model_state_dict(filter_prefix=prefix_model)
+    svd_options = {
+        "svd_backend": svd_backend,
+        "oversample": oversample,
+        "power_iters": power_iters,
+        "check_error": check_error,
+    }
+
+    def save_all(key, tensor):
+        for output_sd in output_sds.values():
+            output_sd[key] = tensor
+
+    to_decompose = {}  # key -> weight (diff), decomposed afterwards in batches of same-shaped layers
+    for k, weight in weights.items():
         if k.endswith(".weight"):
-            weight_diff = sd[k]
             if lora_type == LORAType.STANDARD:
-                if weight_diff.ndim < 2:
+                if weight.ndim < 2:
                     if bias_diff:
-                        output_sd[f"{prefix_lora}{k[len(prefix_model):-7]}.diff"] = (
-                            weight_diff.contiguous().half().cpu()
-                        )
+                        save_all(f"{prefix_lora}{k[len(prefix_model):-7]}.diff", sd[k].contiguous().half().cpu())
                     continue
-                try:
-                    out = extract_lora(weight_diff, rank)
-                    output_sd[f"{prefix_lora}{k[len(prefix_model):-7]}.lora_up.weight"] = (
-                        out[0].contiguous().half().cpu()
-                    )
-                    output_sd[f"{prefix_lora}{k[len(prefix_model):-7]}.lora_down.weight"] = (
-                        out[1].contiguous().half().cpu()
-                    )
-                except:
-                    ryuu_log(
-                        "[Extract and Save LoRA] Could not generate lora weights for key %s, is the weight difference a zero?",
-                        k,
-                    )
+                to_decompose[k] = weight
             elif lora_type == LORAType.FULL_DIFF:
-                output_sd[f"{prefix_lora}{k[len(prefix_model):-7]}.diff"] = weight_diff.contiguous().half().cpu()
+                save_all(f"{prefix_lora}{k[len(prefix_model):-7]}.diff", sd[k].contiguous().half().cpu())
 
         elif bias_diff and k.endswith(".bias"):
-            output_sd[f"{prefix_lora}{k[len(prefix_model):-5]}.diff_b"] = sd[k].contiguous().half().cpu()
-    return output_sd
+            save_all(f"{prefix_lora}{k[len(prefix_model):-5]}.diff_b", sd[k].contiguous().half().cpu())
+
+    errors = {rank: [] for rank in ranks}
+    start = time.perf_counter()
+    batches = plan_batches(to_decompose, svd_batch_bytes)
+    for k, by_rank in _run_batches(batches, sd, ranks, svd_options, workers, threads_per_worker):
+        for rank, out in by_rank.items():
+            output_sds[rank][f"{prefix_lora}{k[len(prefix_model):-7]}.lora_up.weight"] = out[0]
+            output_sds[rank][f"{prefix_lora}{k[len(prefix_model):-7]}.lora_down.weight"] = out[1]
+            errors[rank].append((k, out[2], out[3]))
+
+    elapsed = time.perf_counter() - start
+    for rank, rank_errors in errors.items():
+        _log_svd_errors(rank_errors, svd_backend, elapsed, rank)
+    return output_sds
 
 
 class ExtractAndSaveLora:
@@ -189,6 +330,125 @@ class ExtractAndSaveLora:
                         ),
                     },
                 ),
+                "svd_backend": (
+                    tuple(SVD_BACKENDS.keys()),
+                    {
+                        "default": "full",
+                        "tooltip": (
+                            "full = exact SVD of every weight diff, most of which is thrown away at low ranks.\n"
+                            "randomized = randomized low-rank SVD that only computes about rank + oversample "
+                            "components, many times faster for large layers (especially on CPU) and nearly as exact."
+                        ),
+                    },
+                ),
+                "svd_oversample": (
+                    "INT",
+                    {
+                        "default": 10,
+                        "min": 0,
+                        "max": 512,
+                        "tooltip": "Randomized SVD only: extra components computed and thrown away, more = more exact.",
+                    },
+                ),
+                "svd_power_iters": (
+                    "INT",
+                    {
+                        "default": 2,
+                        "min": 0,
+                        "max": 32,
+                        "tooltip": (
+                            "Randomized SVD only: power iterations, more = more exact for diffs whose singular "
+                            "values fall off slowly, each one costs about two extra passes over the weights."
+                        ),
+                    },
+                ),
+                "svd_batch_mb": (
+                    "INT",
+                    {
+                        "default": 1024,
+                        "min": 0,
+                        "max": 262144,
+                        "step": 64,
+                        "tooltip": (
+                            "Layers of the same shape (attention projections etc.) are decomposed together in batches "
+                            "using about this much memory (MB) at most. 0 = one layer at a time."
+                        ),
+                    },
+                ),
+                "check_svd_error": (
+                    "BOOLEAN",
+                    {
+                        "default": False,
+                        "tooltip": (
+                            "Also computes the singular values of the full SVD for every layer and logs how much "
+                            "worse the chosen backend is than the best possible rank-r result. Slow, for checking "
+                            "settings. The reconstruction error itself is always logged."
+                        ),
+                    },
+                ),
+                "workers": (
+                    "INT",
+                    {
+                        "default": 1,
+                        "min": 1,
+                        "max": 256,
+                        "tooltip": (
+                            "Batches of layers decomposed in parallel, mostly for extracting on many-core CPUs. "
+                            "Each worker needs its own SVD memory (see svd_batch_mb). At the same threads_per_worker "
+                            "the saved LoRA is the same for any number of workers."
+                        ),
+                    },
+                ),
+                "threads_per_worker": (
+                    "INT",
+                    {
+                        "default": 0,
+                        "min": 0,
+                        "max": 1024,
+                        "tooltip": (
+                            "torch CPU threads for each worker, 0 = torch's default (usually one per core) for every "
+                            "worker. Keep workers x threads at about the number of cores. Changing it can change the "
+                            "last bits of the saved weights, the number of workers doesn't."
+                        ),
+                    },
+                ),
+                "shard_size_mb": (
+                    "INT",
+                    {
+                        "default": 0,
+                        "min": 0,
+                        "max": 1048576,
+                        "step": 256,
+                        "tooltip": (
+                            "Splits the saved file into shards of at most this size (MB) with an .index.json, "
+                            "like large HF checkpoints. 0 = a single file. Most LoRA loaders need a single file."
+                        ),
+                    },
+                ),
+                "layer_by_layer": (
+                    "BOOLEAN",
+                    {
+                        "default": False,
+                        "tooltip": (
+                            "Computes the diff of each layer only when it's decomposed instead of loading and "
+                            "patching the whole model first. Needs about one SVD batch (see svd_batch_mb) per worker "
+                            "instead of the whole model in memory, for extracting large models (FLUX, HiDream) "
+                            "on machines with little VRAM or no GPU."
+                        ),
+                    },
+                ),
+                "extra_ranks": (
+                    "STRING",
+                    {
+                        "default": "",
+                        "tooltip": (
+                            "More ranks to save besides rank, comma separated (E.g.: 8, 32, 64). Every layer is "
+                            "decomposed only once at the largest rank and each rank is saved as its own file "
+                            "(_r8, _r32, ...), much faster than extracting every rank separately. "
+                            "Ignored for full_diff."
+                        ),
+                    },
+                ),
             },
             "optional": {
                 "model_diff": (
@@ -235,6 +495,16 @@ class ExtractAndSaveLora:
         skip_on_any_diff_zero,
         skip_on_proj_diff_zero,
         embed_workflow,
+        svd_backend="full",
+        svd_oversample=10,
+        svd_power_iters=2,
+        svd_batch_mb=1024,
+        check_svd_error=False,
+        workers=1,
+        threads_per_worker=0,
+        shard_size_mb=0,
+        layer_by_layer=False,
+        extra_ranks="",
         # optional
         model_diff=None,
         text_encoder_diff=None,
@@ -246,39 +516,33 @@ class ExtractAndSaveLora:
             return {}
 
         lora_type = LORA_TYPES.get(lora_type)
+        # full_diff has nothing rank dependent
+        ranks = _parse_ranks(rank, extra_ranks) if lora_type == LORAType.STANDARD else [rank]
+        svd_options = {
+            "svd_backend": SVD_BACKENDS.get(svd_backend, SVDBackend.FULL),
+            "oversample": svd_oversample,
+            "power_iters": svd_power_iters,
+            "check_error": check_svd_error,
+            "svd_batch_bytes": svd_batch_mb * 1024 * 1024,
+            "workers": workers,
+            "threads_per_worker": threads_per_worker,
+            "layer_by_layer": layer_by_layer,
+        }
         full_output_folder, filename, counter, subfolder, filename_prefix = folder_paths.get_save_image_path(
             filename_prefix, self.output_dir
         )
 
-        output_sd = {}
-        # Process model diffs
-        if model_diff is not None:
-            output_sd = calc_lora_model(
-                model_diff, rank, "diffusion_model.", "diffusion_model.", output_sd, lora_type, bias_diff=bias_diff
-            )
-
-        # Process text encoder diffs with skip logic
+        # Text encoder skip logic, decided up front since it's part of the filename
         has_te_diff = False
         if text_encoder_diff is not None:
             any_zero, proj_zero = _check_text_encoder_diff(text_encoder_diff)
             skip = (skip_on_any_diff_zero and any_zero) or (skip_on_proj_diff_zero and proj_zero)
             if skip:
                 ryuu_log(
-                    "[Extract and Save LoRA] Skipping text encoder diff inclusion (any_zero=%s, proj_zero=%s)",
-                    any_zero,
-                    proj_zero,
+                    "[Extract and Save LoRA] Skipping text encoder diff inclusion "
+                    f"(any_zero={any_zero}, proj_zero={proj_zero})"
                 )
-            else:
-                output_sd = calc_lora_model(
-                    text_encoder_diff.patcher,
-                    rank,
-                    "",
-                    "text_encoders.",
-                    output_sd,
-                    lora_type,
-                    bias_diff=bias_diff,
-                )
-                has_te_diff = True
+            has_te_diff = not skip
 
         # check if extracted lora has text encoder diff in it or biasdiff enabled
         has_te = "_TE" if has_te_diff else "_noTE"
@@ -300,8 +564,56 @@ class ExtractAndSaveLora:
         formatted_suffix = filename_suffix.format(counter=counter)
         formatted_suffix = f"_{formatted_suffix}" if (not filename_suffix == "") else ""
 
-        output_checkpoint = f"{filename}_r{rank}{has_te}{has_biasdiff}{formatted_suffix}.safetensors"
-        output_checkpoint = os.path.join(full_output_folder, output_checkpoint)
+        output_checkpoints = {
+            rank: os.path.join(
+                full_output_folder, f"{filename}_r{rank}{has_te}{has_biasdiff}{formatted_suffix}.safetensors"
+            )
+            for rank in ranks
+        }
+
+        # every weight/bias gives at most two tensors, enough header space to not have to move the data afterwards
+        expected_tensors = 0
+        if model_diff is not None:
+            expected_tensors += 2 * len(model_diff.model_state_dict(filter_prefix="diffusion_model."))
+        if has_te_diff:
+            expected_tensors += 2 * len(text_encoder_diff.patcher.model_state_dict(filter_prefix=""))
+
+        # tensors are written as they're extracted, only one layer at a time is kept in RAM
+        with ExitStack() as stack:
+            output_sds = {
+                rank: stack.enter_context(
+                    SafetensorsStreamWriter(
+                        output_checkpoint,
+                        metadata=metadata,
+                        max_shard_bytes=shard_size_mb * 1024 * 1024,
+                        expected_tensors=expected_tensors,
+                    )
+                )
+                for rank, output_checkpoint in output_checkpoints.items()
+            }
+            # Process model diffs
+            if model_diff is not None:
+                calc_lora_model(
+                    model_diff,
+                    ranks,
+                    "diffusion_model.",
+                    "diffusion_model.",
+                    output_sds,
+                    lora_type,
+                    bias_diff=bias_diff,
+                    **svd_options,
+                )
 
-        comfy.utils.save_torch_file(output_sd, output_checkpoint, metadata=metadata)
+            # Process text encoder diffs
+            if has_te_diff:
+                calc_lora_model(
+                    text_encoder_diff.patcher,
+                    ranks,
+                    "",
+                    "text_encoders.",
+                    output_sds,
+                    lora_type,
+                    bias_diff=bias_diff,
+                    **svd_options,
+                )
         return {}
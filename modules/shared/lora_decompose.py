@@ -0,0 +1,193 @@
+# LoRA decomposition of weight diffs, plain torch so it also works outside of ComfyUI (benchmarks in extras/)
+import math
+from enum import Enum
+
+import torch  # type: ignore
+
+CLAMP_QUANTILE = 0.99
+
+
+class SVDBackend(Enum):
+    FULL = 0
+    RANDOMIZED = 1
+
+
+SVD_BACKENDS = {"full": SVDBackend.FULL, "randomized": SVDBackend.RANDOMIZED}
+
+
+# torch.quantile refuses inputs about this large
+_TORCH_QUANTILE_MAX_VALUES = 2**24
+
+# rough SVD working memory per layer in multiples of its float32 size (stacked input, U/Vh, LAPACK workspace)
+_SVD_MEMORY_FACTOR = 3
+
+
+def _randomized_svd(mats, q, power_iters, seed):
+    """
+    Halko et al. randomized SVD of a batch of matrices with q components, like torch.svd_lowrank
+    but with its own generator, so the result only depends on seed and not on what else used the global RNG
+    (worker threads, other nodes).
+    """
+    transpose = mats.shape[-2] < mats.shape[-1]
+    if transpose:
+        # range finder on the smaller side
+        mats = mats.transpose(-2, -1)
+    generator = torch.Generator(device=mats.device).manual_seed(seed)
+    omega = torch.randn(mats.shape[-1], q, generator=generator, dtype=mats.dtype, device=mats.device)
+
+    Q = torch.linalg.qr(mats @ omega).Q
+    # power iterations sharpen the spectrum for diffs whose singular values fall off slowly
+    for _ in range(power_iters):
+        Q = torch.linalg.qr(mats.transpose(-2, -1) @ Q).Q
+        Q = torch.linalg.qr(mats @ Q).Q
+
+    U, S, Vh = torch.linalg.svd(Q.transpose(-2, -1) @ mats, full_matrices=False)
+    U = Q @ U
+    if transpose:
+        return Vh.transpose(-2, -1), S, U.transpose(-2, -1)
+    return U, S, Vh
+
+
+def _decompose(mats, rank, svd_backend, oversample, power_iters, seed):
+    """Top rank singular triplets of a batch of matrices (B, m, n) as U, S, Vh."""
+    if svd_backend == SVDBackend.RANDOMIZED and rank + oversample < min(mats.shape[-2:]):
+        # only ever works on (rank + oversample) columns instead of the full matrix
+        U, S, Vh = _randomized_svd(mats, rank + oversample, power_iters, seed)
+        return U[..., :rank], S[..., :rank], Vh[..., :rank, :]
+
+    # reduced SVD, the full U/Vh of a wide layer are mostly thrown away anyway
+    U, S, Vh = torch.linalg.svd(mats, full_matrices=False)
+    return U[..., :rank], S[..., :rank], Vh[..., :rank, :]
+
+
+def _relative_error(norm_sq, kept_sq):
+    """Frobenius error of a rank-r approximation relative to the diff, from the kept singular values only."""
+    if norm_sq <= 0:
+        return 0.0
+    return math.sqrt(max(norm_sq - kept_sq, 0.0) / norm_sq)
+
+
+def _as_matrix(diff):
+    """2D version of a linear or conv weight diff"""
+    if len(diff.shape) == 4:
+        if diff.size()[2:4] != (1, 1):
+            return diff.flatten(start_dim=1)
+        return diff.squeeze()
+    return diff
+
+
+def scalable_quantile(values, q):
+    """
+    torch.quantile(values, q) (linear interpolation) for a 1D tensor, which is the fastest while it takes the input.
+    It refuses more than 2**24 values though, which high ranks on wide layers easily get to. Above that a single
+    torch.topk of the top (1 - q) fraction finds the two values next to the quantile instead of sorting everything,
+    that matches torch.quantile to within rounding.
+    """
+    n = values.numel()
+    if n < _TORCH_QUANTILE_MAX_VALUES:
+        return torch.quantile(values, q)
+
+    # position in the input's precision like torch.quantile
+    position = torch.tensor(q, dtype=values.dtype, device=values.device) * (n - 1)
+    below = int(position)
+    # everything from the value at position below upwards, its two smallest are the ones around the quantile
+    top = torch.topk(values, n - below, sorted=False).values
+    if top.numel() == 1:
+        return top[0]
+    low, high = torch.topk(top, 2, largest=False).values
+    return torch.lerp(low, high, position - below)
+
+
+def _lora_weights(diff_shape, rank, U, S, Vh):
+    """Clamped up/down weights in the shape of the layer from the decomposition of one diff."""
+    U = U @ torch.diag(S)
+
+    dist = torch.cat([U.flatten(), Vh.flatten()])
+    hi_val = scalable_quantile(dist, CLAMP_QUANTILE)
+    low_val = -hi_val
+
+    U = U.clamp(low_val, hi_val)
+    Vh = Vh.clamp(low_val, hi_val)
+    if len(diff_shape) == 4:
+        out_dim, in_dim, kernel_h, kernel_w = diff_shape
+        U = U.reshape(out_dim, rank, 1, 1)
+        Vh = Vh.reshape(rank, in_dim, kernel_h, kernel_w)
+    return U, Vh
+
+
+def extract_lora_batch_ranks(
+    diffs, ranks, svd_backend=SVDBackend.FULL, oversample=10, power_iters=2, check_error=False, seed=0
+):
+    """
+    extract_lora_batch() for several ranks at once, every diff is decomposed once at the largest rank and
+    the smaller ones are truncations of it (the top r singular triplets are the same for any larger rank).
+    Returns a list with {rank: extract_lora() result} per diff.
+    """
+    out_dim, in_dim = diffs[0].size()[0:2]
+    max_rank = min(max(ranks), in_dim, out_dim)
+
+    if len(diffs) == 1:
+        mats = _as_matrix(diffs[0]).float().unsqueeze(0)  # no copy just to stack a single one
+    else:
+        mats = torch.stack([_as_matrix(diff).float() for diff in diffs])
+    U, S, Vh = _decompose(mats, max_rank, svd_backend, oversample, power_iters, seed)
+
+    # U and Vh are orthonormal, so ||diff - U S Vh||^2 = ||diff||^2 - ||S||^2
+    norm_sq = torch.linalg.matrix_norm(mats).square().tolist()
+    kept_sq = S.square().cumsum(dim=-1).tolist()  # [i][r - 1] = kept at rank r
+    full_sq = None
+    if check_error:
+        full_sq = torch.linalg.svdvals(mats)[..., :max_rank].square().cumsum(dim=-1).tolist()
+    del mats
+
+    results = []
+    for i, diff in enumerate(diffs):
+        by_rank = {}
+        for rank in ranks:
+            r = min(rank, max_rank)
+            up, down = _lora_weights(diff.shape, r, U[i, :, :r], S[i, :r], Vh[i, :r])
+            error = _relative_error(norm_sq[i], kept_sq[i][r - 1])
+            full_error = _relative_error(norm_sq[i], full_sq[i][r - 1]) if check_error else None
+            by_rank[rank] = (up, down, error, full_error)
+        results.append(by_rank)
+    return results
+
+
+def extract_lora_batch(
+    diffs, rank, svd_backend=SVDBackend.FULL, oversample=10, power_iters=2, check_error=False, seed=0
+):
+    """
+    extract_lora() for several diffs of the same shape, decomposed with one batched call
+    (less per call overhead and better use of multi-core BLAS than one call per layer).
+    seed is only used by the randomized backend. Returns a list with one extract_lora() result per diff.
+    """
+    results = extract_lora_batch_ranks(diffs, [rank], svd_backend, oversample, power_iters, check_error, seed)
+    return [by_rank[rank] for by_rank in results]
+
+
+def extract_lora(
+    diff, rank, svd_backend=SVDBackend.FULL, oversample=10, power_iters=2, check_error=False, seed=0
+):
+    """
+    Returns (up, down, error, full_error). error is the relative reconstruction error (Frobenius) of the kept rank,
+    before clamping. With check_error the singular values of the full SVD are computed too and full_error is
+    the best error any rank-r decomposition could get, else it's None.
+    """
+    return extract_lora_batch([diff], rank, svd_backend, oversample, power_iters, check_error, seed)[0]
+
+
+def plan_batches(diffs, max_batch_bytes):
+    """
+    Groups same-shaped diffs ({key: tensor}) into batches for extract_lora_batch(), each one needing at most
+    about max_batch_bytes of SVD working memory. 0 = no batching. Returns [[key, ...], ...] in a fixed order.
+    """
+    groups = {}
+    for key, diff in diffs.items():
+        groups.setdefault((tuple(diff.shape), diff.dtype, diff.device), []).append(key)
+
+    batches = []
+    for (shape, _, _), keys in groups.items():
+        layer_bytes = math.prod(shape) * 4 * _SVD_MEMORY_FACTOR
+        size = max(1, int(max_batch_bytes // layer_bytes)) if max_batch_bytes else 1
+        batches.extend(keys[i : i + size] for i in range(0, len(keys), size))
+    return batches
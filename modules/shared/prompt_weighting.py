@@ -0,0 +1,176 @@
+import re
+from bisect import bisect_left, bisect_right
+
+# Weight suffix like :1.2, :-0.5, :.5 (the number is optional, '(word:)' is stripped too)
+_WEIGHT_PATTERN = re.compile(r"[-+]?\d*(?:\.\d+)?")
+_SPECIAL_CHARS = re.compile(r"[\\()]")
+
+# weight used for parentheses without an explicit (or with an unparsable) weight, same as ComfyUI
+DEFAULT_PAREN_WEIGHT = 1.1
+
+
+def _is_weight_char(char):
+    return char.isdecimal() or char in ".+-"
+
+
+def parse_weighting(text):
+    """
+    Single pass parser for prompt weighting syntax.
+    (word), (word:1.2), ((word:1.2):0.5) etc. is handled, unbalanced parentheses are kept as-is.
+    Escaped parentheses like \\(word\\) become (word), any other backslash is kept.
+
+    Returns (stripped_text, spans) where spans is a list of (start, end, weight) in stripped_text
+    coordinates, one per parenthesis pair. Weights are local to the pair, see weighted_segments() for nesting.
+    """
+    stripped, spans, _ = _parse(text, track_source=False)
+    return stripped, spans
+
+
+def strip_weighting_with_map(text):
+    """
+    Like strip_weighting() but also returns source_map, the index in text of every char of the stripped text,
+    so positions in the stripped text (e.g. token offsets) can be mapped back to the original.
+    """
+    stripped, _, source_map = _parse(text, track_source=True)
+    return stripped, source_map
+
+
+def _parse(text, track_source):
+    out = []  # output chars, opening parens are never written so nothing has to be removed mid-list
+    src = [] if track_source else None  # index in text of every char in out
+    open_stack = []  # len(out) at each unmatched '('
+    open_src = []  # index in text of each unmatched '('
+    spans = []
+    pos = 0
+
+    for match in _SPECIAL_CHARS.finditer(text):
+        idx = match.start()
+        if idx < pos:  # char was consumed by the escape before it
+            continue
+        # plain text in between is copied in one go
+        out.extend(text[pos:idx])
+        if track_source:
+            src.extend(range(pos, idx))
+        pos = idx + 1
+        char = text[idx]
+
+        if char == "\\":
+            if idx + 1 == len(text):
+                # Handle trailing escape character
+                out.append("\\")
+                if track_source:
+                    src.append(idx)
+            else:
+                escaped_char = text[idx + 1]
+                if escaped_char != "(" and escaped_char != ")":
+                    # Keep the backslash and the char if it wasn't ( or )
+                    out.append("\\")
+                    if track_source:
+                        src.append(idx)
+                out.append(escaped_char)
+                if track_source:
+                    src.append(idx + 1)
+                pos = idx + 2
+        elif char == "(":
+            open_stack.append(len(out))
+            open_src.append(idx)
+        elif open_stack:  # ')'
+            start = open_stack.pop()
+            open_src.pop()
+            weight = DEFAULT_PAREN_WEIGHT
+
+            # the weight can only start at the last ':' of the content, so walk back over number-ish chars
+            colon = len(out) - 1
+            while colon >= start and out[colon] != ":" and _is_weight_char(out[colon]):
+                colon -= 1
+            if colon >= start and out[colon] == ":":
+                number = "".join(out[colon + 1 :])
+                if _WEIGHT_PATTERN.fullmatch(number):
+                    try:
+                        weight = float(number)
+                    except ValueError:
+                        pass
+                    del out[colon:]
+                    if track_source:
+                        del src[colon:]
+                    # spans of nested pairs closed inside this one may have reached into the removed weight
+                    for i in range(len(spans) - 1, -1, -1):
+                        s, e, w = spans[i]
+                        if e <= colon:
+                            break
+                        spans[i] = (min(s, colon), colon, w)
+
+            spans.append((start, len(out), weight))
+        else:  # unmatched ')'
+            out.append(char)
+            if track_source:
+                src.append(idx)
+
+    out.extend(text[pos:])
+    if track_source:
+        src.extend(range(pos, len(text)))
+
+    # Unmatched '(' are put back where they were, spans after them shift by one for each
+    if open_stack:
+        pieces = []
+        prev = 0
+        for pos in open_stack:
+            pieces.append("".join(out[prev:pos]))
+            pieces.append("(")
+            prev = pos
+        pieces.append("".join(out[prev:]))
+        out = pieces
+        if track_source:
+            src_pieces = []
+            prev = 0
+            for pos, paren_idx in zip(open_stack, open_src):
+                src_pieces.extend(src[prev:pos])
+                src_pieces.append(paren_idx)
+                prev = pos
+            src_pieces.extend(src[prev:])
+            src = src_pieces
+        spans = [
+            (s + bisect_right(open_stack, s), e + bisect_left(open_stack, e), w)
+            for s, e, w in spans
+        ]
+
+    return "".join(out), [span for span in spans if span[0] < span[1]], src
+
+
+def strip_weighting(text):
+    """Strips weighting syntax from the text, see parse_weighting()."""
+    return parse_weighting(text)[0]
+
+
+def weighted_segments(text):
+    """
+    Returns the stripped text as a list of (segment, weight) with nested weights multiplied,
+    e.g. 'a ((b:1.2):0.5)' -> [('a ', 1.0), ('b', 0.6)] (give or take float precision).
+    """
+    stripped, spans = parse_weighting(text)
+    # pairs are properly nested, so sorting by (start, -end) puts every parent before its children
+    spans.sort(key=lambda span: (span[0], -span[1]))
+
+    boundaries = {0, len(stripped)}
+    for s, e, _ in spans:
+        boundaries.add(s)
+        boundaries.add(e)
+    boundaries = sorted(boundaries)
+
+    segments = []
+    stack = []  # (end, cumulative weight)
+    span_idx = 0
+    for seg_start, seg_end in zip(boundaries, boundaries[1:]):
+        while stack and stack[-1][0] <= seg_start:
+            stack.pop()
+        while span_idx < len(spans) and spans[span_idx][0] <= seg_start:
+            s, e, w = spans[span_idx]
+            if e > seg_start:
+                stack.append((e, (stack[-1][1] if stack else 1.0) * w))
+            span_idx += 1
+        weight = stack[-1][1] if stack else 1.0
+        if segments and segments[-1][1] == weight:
+            segments[-1] = (segments[-1][0] + stripped[seg_start:seg_end], weight)
+        else:
+            segments.append((stripped[seg_start:seg_end], weight))
+    return segments
@@ -0,0 +1,172 @@
+# Streaming .safetensors writer, tensors go to disk as they are added instead of being collected in a state dict first
+import json
+import os
+import struct
+
+import torch  # type: ignore
+
+_DTYPES = {
+    torch.float64: "F64",
+    torch.float32: "F32",
+    torch.float16: "F16",
+    torch.bfloat16: "BF16",
+    torch.int64: "I64",
+    torch.int32: "I32",
+    torch.int16: "I16",
+    torch.int8: "I8",
+    torch.uint8: "U8",
+    torch.bool: "BOOL",
+}
+for _name, _code in (("float8_e4m3fn", "F8_E4M3"), ("float8_e5m2", "F8_E5M2")):
+    if hasattr(torch, _name):
+        _DTYPES[getattr(torch, _name)] = _code
+
+# header space reserved per tensor on top of the metadata, entries are about 100 bytes + the key
+HEADER_BYTES_PER_TENSOR = 256
+_COPY_CHUNK = 64 * 1024 * 1024
+
+
+class _Shard:
+    def __init__(self, path, header_reserve):
+        self.path = path
+        self.part_path = f"{path}.part"
+        self.header_reserve = header_reserve
+        self.entries = {}
+        self.size = 0  # data bytes
+        self.file = open(self.part_path, "wb")
+        # data starts after the reserved header, which is written last once all offsets are known
+        self.file.seek(8 + header_reserve)
+
+    def write(self, key, tensor):
+        data = tensor.detach().contiguous().cpu()
+        if data.dtype not in _DTYPES:
+            raise ValueError(f"Can't save {key}: unsupported dtype {data.dtype}")
+        nbytes = data.numel() * data.element_size()
+        self.entries[key] = {
+            "dtype": _DTYPES[data.dtype],
+            "shape": list(data.shape),
+            "data_offsets": [self.size, self.size + nbytes],
+        }
+        if nbytes:
+            self.file.write(data.reshape(-1).view(torch.uint8).numpy().data)
+        self.size += nbytes
+
+    def finish(self, metadata):
+        header = {"__metadata__": metadata} if metadata else {}
+        header.update(self.entries)
+        header = json.dumps(header, separators=(",", ":")).encode()
+        if len(header) <= self.header_reserve:
+            # trailing spaces are valid header padding
+            self.file.seek(0)
+            self.file.write(struct.pack("<Q", self.header_reserve))
+            self.file.write(header.ljust(self.header_reserve, b" "))
+            self.file.close()
+        else:
+            self.file.close()
+            self._rewrite(header)
+        os.replace(self.part_path, self.path)
+
+    def _rewrite(self, header):
+        """Header didn't fit the reserved space, copies the data behind a bigger one."""
+        padded = header.ljust(-(-len(header) // 8) * 8, b" ")
+        moved_path = f"{self.part_path}.tmp"
+        with open(self.part_path, "rb") as source, open(moved_path, "wb") as target:
+            target.write(struct.pack("<Q", len(padded)))
+            target.write(padded)
+            source.seek(8 + self.header_reserve)
+            while chunk := source.read(_COPY_CHUNK):
+                target.write(chunk)
+        os.replace(moved_path, self.part_path)
+
+    def abort(self):
+        self.file.close()
+        for path in (self.part_path, f"{self.part_path}.tmp"):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class SafetensorsStreamWriter:
+    """
+    Writes a .safetensors file one tensor at a time, writer[key] = tensor writes it right away, so only the tensor
+    being written has to be in RAM. The header is reserved up front (metadata + expected_tensors entries) and filled
+    in by close(), if it turns out too small the data gets copied once behind a bigger header.
+    The file is written as path + ".part" and only renamed to path by close(), so failed runs leave no broken file.
+
+    With max_shard_bytes a new shard is started when the next tensor wouldn't fit anymore, the shards are named
+    like HF's "<name>-00001-of-00003.safetensors" and get a "<name>.safetensors.index.json" with the key -> shard map.
+    Every shard gets the full metadata. Returns the written paths from close().
+    Use as a context manager, leaving it with an exception removes the partial files.
+    """
+
+    def __init__(self, path, metadata=None, max_shard_bytes=0, expected_tensors=1024):
+        self.path = path
+        self.metadata = {str(k): str(v) for k, v in (metadata or {}).items()}
+        self.max_shard_bytes = max_shard_bytes
+        metadata_bytes = len(json.dumps({"__metadata__": self.metadata}, separators=(",", ":")).encode())
+        header_reserve = metadata_bytes + HEADER_BYTES_PER_TENSOR * expected_tensors
+        self._header_reserve = -(-header_reserve // 8) * 8  # keeps the tensor data 8 byte aligned
+        self._shards = []
+        self._keys = set()
+        self._new_shard()
+
+    def _new_shard(self):
+        index = len(self._shards) + 1
+        # final names of the shards are only known once all of them are written, see close()
+        path = f"{os.path.splitext(self.path)[0]}-{index:05}.safetensors" if self.max_shard_bytes else self.path
+        self._shards.append(_Shard(path, self._header_reserve))
+
+    def __setitem__(self, key, tensor):
+        if key in self._keys:
+            raise KeyError(f"{key} was already written")
+        shard = self._shards[-1]
+        nbytes = tensor.numel() * tensor.element_size()
+        if self.max_shard_bytes and shard.entries and shard.size + nbytes > self.max_shard_bytes:
+            self._new_shard()
+            shard = self._shards[-1]
+        shard.write(key, tensor)
+        self._keys.add(key)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __len__(self):
+        return len(self._keys)
+
+    def close(self):
+        if len(self._shards) == 1 and self.max_shard_bytes:
+            # everything fit into one shard, no need for an index
+            self._shards[0].path = self.path
+        for shard in self._shards:
+            shard.finish(self.metadata)
+        if len(self._shards) == 1:
+            return [self.path]
+
+        base = os.path.splitext(self.path)[0]
+        count = len(self._shards)
+        weight_map = {}
+        paths = []
+        for index, shard in enumerate(self._shards, start=1):
+            path = f"{base}-{index:05}-of-{count:05}.safetensors"
+            os.replace(shard.path, path)
+            paths.append(path)
+            weight_map.update({key: os.path.basename(path) for key in shard.entries})
+        index = {
+            "metadata": {"total_size": sum(shard.size for shard in self._shards)},
+            "weight_map": dict(sorted(weight_map.items())),
+        }
+        with open(f"{self.path}.index.json", "w", encoding="utf-8") as f:
+            json.dump(index, f, indent=2)
+        return paths
+
+    def abort(self):
+        for shard in self._shards:
+            shard.abort()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
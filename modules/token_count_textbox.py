@@ -1,24 +1,166 @@
+import asyncio
+
+from ..pyserver.token_count_routes import BUDGET_MODES
+
+
+# same as token_counting.CLIP_CHUNK_SIZE, not imported from there since that loads transformers,
+# which isn't needed in this process with the standalone token count service
+_CLIP_CHUNK_SIZE = 75
+_CLIP_SPECIAL_TOKENS = 2  # BOS + EOS
+
+
+def _run_on_backend(function_name, **kwargs):
+    """
+    Runs one of the async token count backend functions from a node, on the same backend as the routes
+    (in process or the standalone service). Nodes run in the prompt worker thread, outside of the event loop.
+    """
+    from server import PromptServer  # type: ignore
+
+    from ..pyserver.update_token_count import backend
+
+    future = asyncio.run_coroutine_threadsafe(getattr(backend, function_name)(**kwargs), PromptServer.instance.loop)
+    return future.result()
+
+
 class TokenCountTextBox:
     @classmethod
     def INPUT_TYPES(cls):
         return {
             "required": {
                 "input_text": ("STRING", {"default": "", "multiline": True}),
-            }
+            },
+            "optional": {
+                "tokenizer_a": (
+                    "STRING",
+                    {
+                        "default": "",
+                        "tooltip": (
+                            "Tokenizer for the token_count_a output, same names as in the token counter settings "
+                            "(e.g. CLIP_L). Empty = not counted, output is 0."
+                        ),
+                    },
+                ),
+                "tokenizer_b": ("STRING", {"default": "", "tooltip": "Same as tokenizer_a, for token_count_b."}),
+                "add_special_tokens": ("BOOLEAN", {"default": False}),
+                "support_break_keyword": ("BOOLEAN", {"default": False, "tooltip": "Only used with CLIP_L."}),
+            },
         }
 
     CATEGORY = "RyuuNoodles 🐲/Text"
 
-    RETURN_TYPES = ("STRING",)
-    RETURN_NAMES = ("text",)
+    RETURN_TYPES = ("STRING", "INT", "INT", "INT")
+    RETURN_NAMES = ("text", "token_count_a", "token_count_b", "clip_chunks")
+    OUTPUT_TOOLTIPS = (
+        "The text as-is.",
+        "Token count of tokenizer_a, counted like the token counter overlay does.",
+        "Token count of tokenizer_b.",
+        "Number of 75 token CLIP chunks, if one of the tokenizers is CLIP_L.",
+    )
     FUNCTION = "dooooooooodooooo"
 
     DESCRIPTION = (
         "A simple textbox. It is meant to show a token counter ontop of the textbox widget by default "
         "and serve as an example for setting up token counters on custom nodes.\n"
-        "Please see the 'RyuuNoodles 🐲' settings page to configure the token counter."
+        "Please see the 'RyuuNoodles 🐲' settings page to configure the token counter.\n"
+        "Optionally outputs token counts, e.g. to switch on prompt length."
     )
 
-    def dooooooooodooooo(self, input_text):
+    def dooooooooodooooo(
+        self, input_text, tokenizer_a="", tokenizer_b="", add_special_tokens=False, support_break_keyword=False
+    ):
+        names = [name.strip() for name in (tokenizer_a, tokenizer_b)]
+        tok_types = [name for name in names if name]
+        if not input_text or not tok_types:
+            return {"ui": {"text": input_text}, "result": (input_text, 0, 0, 0)}
+
+        # results are cached on text + settings (memory + sqlite), so unchanged prompts don't touch a tokenizer
+        data = _run_on_backend(
+            "compute_token_counts",
+            text=input_text,
+            tok_types=tok_types,
+            add_special_tokens=add_special_tokens,
+            support_break_keyword=support_break_keyword,
+            allow_estimates=False,
+        )
+        counts = data["token_counts"]
+        unknown = [name for name in tok_types if counts.get(name) is None]
+        if unknown:
+            raise ValueError(f"Unknown tokenizer(s): {', '.join(unknown)}")
+
+        clip_chunks = 0
+        clip_name = next((name for name in tok_types if name.lower() == "clip_l"), None)
+        if clip_name is not None:
+            chunks = data.get("chunks", {}).get(clip_name)
+            if chunks:
+                clip_chunks = len(chunks)
+            else:
+                tokens = counts[clip_name] - (_CLIP_SPECIAL_TOKENS if add_special_tokens else 0)
+                clip_chunks = max(1, -(-tokens // _CLIP_CHUNK_SIZE))
+
+        result = tuple(counts[name] if name else 0 for name in names)
+        return {"ui": {"text": input_text}, "result": (input_text, *result, clip_chunks)}
+
+
+class TokenBudgetTextBox:
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {
+            "required": {
+                "input_text": ("STRING", {"default": "", "multiline": True}),
+                "tokenizers": (
+                    "STRING",
+                    {
+                        "default": "CLIP_L",
+                        "tooltip": (
+                            "Comma separated tokenizers, same names as in the token counter settings.\n"
+                            "With more than one the text is cut so it fits for all of them."
+                        ),
+                    },
+                ),
+                "budget": ("INT", {"default": 75, "min": 0, "max": 1000000, "tooltip": "Max. amount of tokens."}),
+                "mode": (
+                    list(BUDGET_MODES),
+                    {
+                        "default": "tags",
+                        "tooltip": (
+                            "prefix = cut after the last token that fits\n"
+                            "tags = cut before a comma so no tag gets cut in half"
+                        ),
+                    },
+                ),
+                "add_special_tokens": ("BOOLEAN", {"default": False}),
+                "support_break_keyword": ("BOOLEAN", {"default": False, "tooltip": "Only used with CLIP_L."}),
+            }
+        }
+
+    CATEGORY = "RyuuNoodles 🐲/Text"
+
+    RETURN_TYPES = ("STRING", "STRING", "INT")
+    RETURN_NAMES = ("text", "remainder", "token_count")
+    FUNCTION = "fit"
+
+    DESCRIPTION = (
+        "Textbox that cuts its text to the longest start that fits in the token budget, "
+        "the cut off part comes out as remainder. Token counts are the same as the token counter shows."
+    )
+
+    def fit(self, input_text, tokenizers, budget, mode, add_special_tokens, support_break_keyword):
+        tok_types = [name.strip() for name in tokenizers.split(",") if name.strip()]
+        if not input_text or not tok_types:
+            return {"ui": {"text": input_text}, "result": (input_text, "", 0)}
+
+        data = _run_on_backend(
+            "compute_token_budget",
+            text=input_text,
+            tok_types=tok_types,
+            budget=budget,
+            mode=mode,
+            add_special_tokens=add_special_tokens,
+            support_break_keyword=support_break_keyword,
+        )
+        if data["tokenizer"] is None:
+            raise ValueError(f"Unknown tokenizer(s): {tokenizers}")
 
-        return {"ui": {"text": input_text}, "result": (input_text,)}
+        cut = data["cut"]
+        count = data["cuts"][data["tokenizer"]]["count"]
+        return {"ui": {"text": input_text[:cut]}, "result": (input_text[:cut], input_text[cut:], count)}
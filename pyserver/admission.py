@@ -0,0 +1,131 @@
+import asyncio
+import os
+
+from .metrics import THROTTLED_REQUESTS
+
+# Limits for the token count routes, so a pasted megabyte of text or a flood of requests can't pin the CPU
+# 0 disables a limit
+MAX_TEXT_LENGTH = int(os.environ.get("RYUU_TOKENCOUNT_MAX_TEXT_LENGTH", "") or 100_000)  # chars
+MAX_TOKENIZERS = int(os.environ.get("RYUU_TOKENCOUNT_MAX_TOKENIZERS", "") or 16)  # per text
+MAX_BATCH_ITEMS = int(os.environ.get("RYUU_TOKENCOUNT_MAX_BATCH_ITEMS", "") or 256)
+MAX_BODY_BYTES = int(os.environ.get("RYUU_TOKENCOUNT_MAX_BODY_BYTES", "") or 8 * 1024 * 1024)
+# requests per client (IP) that are worked on at the same time, and how many more may wait for a slot
+CLIENT_CONCURRENCY = int(os.environ.get("RYUU_TOKENCOUNT_CLIENT_CONCURRENCY", "") or 4)
+CLIENT_QUEUE = int(os.environ.get("RYUU_TOKENCOUNT_CLIENT_QUEUE", "") or 32)
+
+# seconds the client should wait before trying again when its queue is full
+RETRY_AFTER = 1
+
+
+class LimitExceeded(Exception):
+    """
+    A request was turned away by one of the limits above. limit is a short name the frontend can act on
+    (text_length, tokenizers, batch_items, body_size or concurrency), retry_after is only set if trying again helps.
+    """
+
+    def __init__(self, limit, message, status=413, retry_after=None):
+        super().__init__(message)
+        self.limit = limit
+        self.message = message
+        self.status = status
+        self.retry_after = retry_after
+
+    def to_json(self):
+        data = {"error": self.message, "limit": self.limit}
+        if self.retry_after is not None:
+            data["retry_after"] = self.retry_after
+        return data
+
+    def headers(self):
+        return {"Retry-After": str(self.retry_after)} if self.retry_after is not None else None
+
+    @classmethod
+    def from_json(cls, data, status):
+        """Counterpart of to_json(), for errors passed through from the standalone service."""
+        return cls(data["limit"], data.get("error", ""), status, data.get("retry_after"))
+
+
+def check_payload(text, tok_types):
+    """Raises LimitExceeded if a single count request is too big."""
+    if MAX_TEXT_LENGTH and len(text) > MAX_TEXT_LENGTH:
+        THROTTLED_REQUESTS.inc(limit="text_length")
+        raise LimitExceeded("text_length", f"Text is too long ({len(text)} chars, max. {MAX_TEXT_LENGTH})")
+    if MAX_TOKENIZERS and len(tok_types) > MAX_TOKENIZERS:
+        THROTTLED_REQUESTS.inc(limit="tokenizers")
+        raise LimitExceeded("tokenizers", f"Too many tokenizers ({len(tok_types)}, max. {MAX_TOKENIZERS})")
+
+
+def check_batch_size(count):
+    if MAX_BATCH_ITEMS and count > MAX_BATCH_ITEMS:
+        THROTTLED_REQUESTS.inc(limit="batch_items")
+        raise LimitExceeded("batch_items", f"Too many items ({count}, max. {MAX_BATCH_ITEMS})")
+
+
+def check_body_size(content_length):
+    """content_length is None for chunked requests, aiohttp's own client_max_size still applies to those."""
+    if MAX_BODY_BYTES and content_length is not None and content_length > MAX_BODY_BYTES:
+        THROTTLED_REQUESTS.inc(limit="body_size")
+        raise LimitExceeded("body_size", f"Request body is too large ({content_length} bytes, max. {MAX_BODY_BYTES})")
+
+
+class _ClientState:
+    def __init__(self):
+        self.semaphore = asyncio.Semaphore(CLIENT_CONCURRENCY)
+        self.users = 0  # running + waiting
+
+
+class ClientLimiter:
+    """
+    Per client concurrency limit. Up to CLIENT_CONCURRENCY requests of a client run at once,
+    up to CLIENT_QUEUE more wait for a slot and anything beyond that is rejected with LimitExceeded("concurrency").
+    Only used from the event loop, so no locking. enabled=False lets everything through.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._clients = {}
+
+    def slot(self, client):
+        """async with limiter.slot(client): ..."""
+        return _ClientSlot(self, client)
+
+
+class _ClientSlot:
+    def __init__(self, limiter, client):
+        self._limiter = limiter
+        self._client = client
+        self._state = None
+
+    async def __aenter__(self):
+        if not CLIENT_CONCURRENCY or not self._limiter.enabled:
+            return self
+        clients = self._limiter._clients
+        state = clients.get(self._client)
+        if state is None:
+            state = clients[self._client] = _ClientState()
+        if state.users >= CLIENT_CONCURRENCY + CLIENT_QUEUE:
+            THROTTLED_REQUESTS.inc(limit="concurrency")
+            raise LimitExceeded(
+                "concurrency", "Too many token count requests at once", status=429, retry_after=RETRY_AFTER
+            )
+
+        state.users += 1
+        try:
+            await state.semaphore.acquire()
+        except BaseException:  # cancelled while waiting
+            self._leave(state)
+            raise
+        self._state = state
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self._state is not None:
+            self._state.semaphore.release()
+            self._leave(self._state)
+            self._state = None
+
+    def _leave(self, state):
+        state.users -= 1
+        if not state.users:
+            # nothing running or waiting, don't keep an entry for every client ever seen
+            self._limiter._clients.pop(self._client, None)
@@ -0,0 +1,111 @@
+import re
+import threading
+from collections import OrderedDict
+
+# segments end after a comma, BREAK is a segment of its own
+_BOUNDARY_PATTERN = re.compile(r",|(?<!\w)BREAK(?!\w)")
+_HAS_WORD_PATTERN = re.compile(r"\w")
+
+
+def split_segments(text):
+    """
+    Splits text into segments on comma and BREAK boundaries, "".join(segments) == text.
+    Segments without any word character (e.g. ', ,' runs) are merged into the previous one,
+    so no token can span more than one boundary.
+    """
+    segments = []
+    pos = 0
+    for match in _BOUNDARY_PATTERN.finditer(text):
+        if match.group() == ",":
+            cuts = (match.end(),)
+        else:
+            cuts = (match.start(), match.end())
+        for cut in cuts:
+            if cut > pos:
+                segments.append(text[pos:cut])
+                pos = cut
+    if pos < len(text):
+        segments.append(text[pos:])
+
+    merged = []
+    for segment in segments:
+        if merged and not _HAS_WORD_PATTERN.search(segment):
+            merged[-1] += segment
+        else:
+            merged.append(segment)
+    return merged
+
+
+class _SegmentState:
+    __slots__ = ("segments", "count", "updates")
+
+    def __init__(self, segments, count):
+        self.segments = segments
+        self.count = count
+        self.updates = 0  # incremental updates since the last full count
+
+
+class IncrementalTokenCounter:
+    """
+    Remembers the last segmentation and token count per state key (client/node + tokenizer settings).
+    On the next request only the segments that changed are re-tokenized, together with one unchanged
+    neighbour on each side so tokens at the boundaries are reconciled:
+        new_count = old_count + count(left + new_changed + right) - count(left + old_changed + right)
+    The count is redone in full every `resync_every` updates or if more than `max_changed_ratio`
+    of the segments changed, since at that point the window is not much smaller than the full text.
+    """
+
+    def __init__(self, max_states=256, resync_every=50, max_changed_ratio=0.5):
+        self.max_states = max_states
+        self.resync_every = resync_every
+        self.max_changed_ratio = max_changed_ratio
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+
+    def count(self, state_key, text, count_fn):
+        """
+        count_fn(text) has to return the token count of text without special tokens.
+        Callers must not run two counts for the same state_key at the same time (the tokenizer lock takes care of that).
+        """
+        segments = split_segments(text)
+        with self._lock:
+            state = self._states.get(state_key)
+            if state is not None:
+                self._states.move_to_end(state_key)
+
+        if state is None or (self.resync_every and state.updates >= self.resync_every):
+            return self._store(state_key, _SegmentState(segments, count_fn(text)))
+
+        old = state.segments
+        if old == segments:
+            return state.count
+
+        # common prefix and suffix (in segments), not overlapping
+        max_common = min(len(old), len(segments))
+        prefix = 0
+        while prefix < max_common and old[prefix] == segments[prefix]:
+            prefix += 1
+        suffix = 0
+        while suffix < max_common - prefix and old[-1 - suffix] == segments[-1 - suffix]:
+            suffix += 1
+
+        changed = max(len(old), len(segments)) - prefix - suffix
+        if changed > self.max_changed_ratio * max(len(old), len(segments)):
+            return self._store(state_key, _SegmentState(segments, count_fn(text)))
+
+        left = old[prefix - 1] if prefix else ""
+        right = old[len(old) - suffix] if suffix else ""
+        old_window = left + "".join(old[prefix : len(old) - suffix]) + right
+        new_window = left + "".join(segments[prefix : len(segments) - suffix]) + right
+
+        new_state = _SegmentState(segments, state.count + count_fn(new_window) - count_fn(old_window))
+        new_state.updates = state.updates + 1
+        return self._store(state_key, new_state)
+
+    def _store(self, state_key, state):
+        with self._lock:
+            self._states[state_key] = state
+            self._states.move_to_end(state_key)
+            while len(self._states) > self.max_states:
+                self._states.popitem(last=False)
+        return state.count
@@ -4,10 +4,13 @@ from aiohttp import web
 
 from server import PromptServer  # type: ignore
 
+from .metrics import track_route
+
 routes = PromptServer.instance.routes
 
 
 @routes.put("/ryuu/set_loglevel")
+@track_route("set_loglevel")
 async def set_loglevel(request):
     try:
         data = await request.json()
@@ -0,0 +1,146 @@
+import bisect
+import functools
+import threading
+import time
+
+from aiohttp import web
+
+# Small Prometheus text format exposition, prometheus_client isn't a dependency and this only needs a handful of metrics
+# Everything is process local, with the standalone token count service that one has its own /ryuu/metrics
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+_metrics = []
+_collectors = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(labels)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self._values = {}  # labels -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._values.get(key)
+            if values is None:
+                values = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            values[bisect.bisect_left(self.buckets, value)] += 1
+            values[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, values in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), values):
+                    cumulative += count
+                    bucket_labels = labels + (("le", _format_value(float(bound))),)
+                    lines.append(f"{self.name}_bucket{_format_labels(bucket_labels)} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(values[-1])}")
+                lines.append(f"{self.name}_count{_format_labels(labels)} {cumulative}")
+        return lines
+
+
+def register_collector(collect):
+    """
+    collect() is called on every scrape and returns [(name, type, help, [(labels dict, value), ...]), ...],
+    for values that already live somewhere else (cache stats, tokenizer status, queue sizes).
+    """
+    _collectors.append(collect)
+
+
+def render_metrics():
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    for collect in _collectors:
+        for name, metric_type, help_text, samples in collect():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels, value in samples:
+                lines.append(f"{name}{_format_labels(sorted(labels.items()))} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+HTTP_REQUESTS = Counter("ryuu_http_requests_total", "Requests to the RyuuNoodles routes by route and status.")
+HTTP_REQUEST_SECONDS = Histogram("ryuu_http_request_duration_seconds", "Time to answer a request by route.")
+HTTP_REQUEST_BYTES = Histogram(
+    "ryuu_http_request_size_bytes", "Request body size by route (websocket: per message).", SIZE_BUCKETS
+)
+TOKENIZER_REQUESTS = Counter(
+    "ryuu_tokenizer_requests_total",
+    "Token counts asked for per tokenizer, by source (cache, tokenizer, estimate or budget).",
+)
+THROTTLED_REQUESTS = Counter("ryuu_tokencount_throttled_total", "Token count requests turned away, by limit.")
+TOKENIZER_ENCODE_SECONDS = Histogram(
+    "ryuu_tokenizer_encode_seconds", "Time spent encoding per tokenizer call (single or batch), lock wait excluded."
+)
+
+
+def track_route(route):
+    """Decorator for aiohttp handlers, records request count, duration and body size under the route name."""
+
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(request):
+            start = time.perf_counter()
+            status = 500
+            try:
+                response = await handler(request)
+                status = response.status
+                return response
+            except web.HTTPException as e:
+                status = e.status
+                raise
+            finally:
+                HTTP_REQUESTS.inc(route=route, status=status)
+                HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, route=route)
+                if request.content_length is not None:
+                    HTTP_REQUEST_BYTES.observe(request.content_length, route=route)
+
+        return wrapper
+
+    return decorator
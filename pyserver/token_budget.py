@@ -0,0 +1,126 @@
+import re
+from bisect import bisect_right
+
+from ..modules.shared.prompt_weighting import strip_weighting, strip_weighting_with_map
+from .token_counting import (
+    BREAK_PATTERN,
+    CLIP_CHUNK_SIZE,
+    _num_tokens,
+    _token_segments,
+    handle_clip_l_breaks,
+)
+from .tokenizer_loader import get_tokenizer, get_tokenizer_lock, resolve_key
+
+_COMMA_PATTERN = re.compile(",")
+# end of a word, where slow tokenizers (no offsets) are allowed to cut
+_WORD_END_PATTERN = re.compile(r"[^\s,](?=[\s,]|$)")
+
+
+def _prefix_counts(offsets, text, specials, clip_breaks):
+    """
+    Counts like the overlay shows them for every prefix of the tokens, from the offsets of a single encode call.
+    Returns (end offset of every token, count of the first k tokens for k = 0..n, count of the whole text).
+    With BREAK the finished segments are padded to full CLIP chunks, the BREAK keywords themselves don't count.
+    """
+    breaks = [match.span() for match in BREAK_PATTERN.finditer(text)] if clip_breaks else []
+    ends = []
+    counts = [specials]
+    padded = 0  # tokens of the finished segments incl. padding
+    current = 0  # tokens of the current segment
+    segment = 0
+    for (_, end), token_segment in zip(offsets, _token_segments(offsets, breaks)):
+        if token_segment is None:
+            continue
+        while segment < token_segment:
+            padded += CLIP_CHUNK_SIZE * max(1, -(-current // CLIP_CHUNK_SIZE))
+            current = 0
+            segment += 1
+        current += 1
+        ends.append(end)
+        counts.append(specials + padded + current)
+
+    while segment < len(breaks):
+        padded += CLIP_CHUNK_SIZE * max(1, -(-current // CLIP_CHUNK_SIZE))
+        current = 0
+        segment += 1
+    return ends, counts, specials + padded + current
+
+
+def _raw_cut(raw_text, source_map, cut):
+    """Maps a cut in the stripped text back to raw_text, keeping closing parens/weights of the kept text."""
+    if cut >= len(source_map):
+        return len(raw_text)
+    if cut == 0:
+        return 0
+    raw_cut = source_map[cut]
+    # but not the '(' of a group that only starts after the cut
+    while raw_cut > 0 and raw_text[raw_cut - 1] == "(" and (raw_cut < 2 or raw_text[raw_cut - 2] != "\\"):
+        raw_cut -= 1
+    return raw_cut
+
+
+def fit_token_budget(name, raw_text, budget, mode="prefix", add_special_tokens=False, support_break_keyword=False):
+    """
+    Blocking, finds the longest prefix of raw_text that still fits in budget tokens (counted like the overlay does,
+    weighting syntax stripped). mode "prefix" can cut after any token, "tags" only right before a comma.
+    Fast tokenizers get the cut from the offsets of a single encode call, which is then checked once on the actual
+    prefix (a cut word or unbalanced parenthesis can tokenize differently) and moved back a step if needed.
+    Slow tokenizers have no offsets, they binary search over word ends/commas instead.
+    Returns {"cut": index into raw_text, "count": count of raw_text[:cut], "fits": True if nothing had to be cut}
+    or None for unknown tokenizers.
+    """
+    tokenizer = get_tokenizer(name)
+    if tokenizer is None:
+        return None
+
+    key = resolve_key(name)
+    clip_breaks = key == "clip_l" and support_break_keyword
+    text, source_map = strip_weighting_with_map(raw_text)
+    if mode == "tags":
+        candidates = [0] + [match.start() for match in _COMMA_PATTERN.finditer(text)]
+    else:
+        candidates = [0] + [match.end() for match in _WORD_END_PATTERN.finditer(text)]
+
+    with get_tokenizer_lock(key):
+        specials = tokenizer.num_special_tokens_to_add() if add_special_tokens else 0
+
+        def count_prefix(raw_cut):
+            prefix = strip_weighting(raw_text[:raw_cut])
+            if clip_breaks:
+                return handle_clip_l_breaks(prefix, tokenizer, add_special_tokens)[0]
+            return specials + _num_tokens(tokenizer, prefix)
+
+        if getattr(tokenizer, "is_fast", False):
+            encoding = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)
+            ends, counts, total = _prefix_counts(encoding["offset_mapping"], text, specials, clip_breaks)
+            if total <= budget:
+                return {"cut": len(raw_text), "count": total, "fits": True}
+
+            if mode != "tags":
+                candidates = [0] + ends
+            # longest first, only the ones that fit going by the offsets
+            for cut in reversed(candidates):
+                if counts[bisect_right(ends, cut)] > budget:
+                    continue
+                raw_cut = _raw_cut(raw_text, source_map, cut)
+                count = count_prefix(raw_cut)
+                if count <= budget:
+                    return {"cut": raw_cut, "count": count, "fits": False}
+            return {"cut": 0, "count": specials, "fits": False}
+
+        count = count_prefix(len(raw_text))
+        if count <= budget:
+            return {"cut": len(raw_text), "count": count, "fits": True}
+        # the count only grows with the prefix, so the last fitting candidate can be searched for
+        best = {"cut": 0, "count": specials, "fits": False}
+        low, high = 1, len(candidates) - 1
+        while low <= high:
+            mid = (low + high) // 2
+            raw_cut = _raw_cut(raw_text, source_map, candidates[mid])
+            count = count_prefix(raw_cut)
+            if count <= budget:
+                best = {"cut": raw_cut, "count": count, "fits": False}
+                low = mid + 1
+            else:
+                high = mid - 1
+        return best
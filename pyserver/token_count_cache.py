@@ -0,0 +1,146 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from ..modules.shared.ryuu_log import ryuu_log
+from .tokenizer_loader import _spec_id, resolve_key
+
+# bump this if the way counts are computed changes, so old persisted counts aren't served anymore
+CACHE_VERSION = 1
+
+
+def make_cache_key(text, tok_name, add_special_tokens=False, support_break_keyword=False):
+    """
+    Key is (text hash, tokenizer, add_special_tokens, support_break_keyword). The tokenizer part is the resolved key
+    plus a hash of its spec (class, repo/path, kwargs), so aliases share entries and a tokenizer that tokenizers.json
+    points somewhere else doesn't get the old one's persisted counts.
+    """
+    text_hash = hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+    key = resolve_key(tok_name)
+    spec_hash = hashlib.blake2b(_spec_id(key).encode("utf-8"), digest_size=8).hexdigest()
+    return (text_hash, f"{key}|{spec_hash}", bool(add_special_tokens), bool(support_break_keyword))
+
+
+class TokenCountCache:
+    """
+    Two-tier cache for token count results (anything JSON serializable, e.g. {"count": 12}).
+    First tier is a bounded in-memory LRU, second tier is an optional sqlite file so counts survive restarts.
+    Everything is guarded by a single lock, entries are tiny so contention is negligible.
+    """
+
+    def __init__(self, max_entries=2048, db_path=None, max_db_entries=50000):
+        self.max_entries = max_entries
+        self.max_db_entries = max_db_entries
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._db_writes = 0
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if db_path:
+            try:
+                os.makedirs(os.path.dirname(db_path), exist_ok=True)
+                self._db = sqlite3.connect(db_path, check_same_thread=False)
+                self._db.execute("PRAGMA journal_mode=WAL")
+                self._db.execute("PRAGMA synchronous=OFF")
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS token_count_results ("
+                    "text_hash TEXT, tok_name TEXT, special INTEGER, break_kw INTEGER, version INTEGER, "
+                    "value TEXT, PRIMARY KEY (text_hash, tok_name, special, break_kw, version))"
+                )
+                self._db.execute("DELETE FROM token_count_results WHERE version != ?", (CACHE_VERSION,))
+                self._db.commit()
+            except sqlite3.Error as e:
+                ryuu_log(f"[TokenCountCache] Could not open persistent cache at {db_path}: {e}", loglevel="warning")
+                self._db = None
+
+    def get(self, key):
+        """Returns the cached result or None on a miss. Disk hits are promoted into the LRU."""
+        with self._lock:
+            if key in self._lru:
+                self._lru.move_to_end(key)
+                self.hits += 1
+                return self._lru[key]
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT value FROM token_count_results "
+                    "WHERE text_hash=? AND tok_name=? AND special=? AND break_kw=? AND version=?",
+                    (*key, CACHE_VERSION),
+                ).fetchone()
+                if row is not None:
+                    self.hits += 1
+                    self.disk_hits += 1
+                    value = json.loads(row[0])
+                    self._put_lru(key, value)
+                    return value
+
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        if value is None or (isinstance(value, dict) and value.get("count") is None):
+            return  # unknown tokenizer, not worth remembering
+        if isinstance(value, dict) and value.get("approximate"):
+            return  # estimate while the tokenizer loads, the real count replaces it soon
+        with self._lock:
+            self._put_lru(key, value)
+            if self._db is not None:
+                try:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO token_count_results VALUES (?, ?, ?, ?, ?, ?)",
+                        (*key, CACHE_VERSION, json.dumps(value)),
+                    )
+                    self._db.commit()
+                    self._db_writes += 1
+                    # prune every now and then instead of on every write
+                    if self._db_writes % 1000 == 0:
+                        self._prune_db()
+                except sqlite3.Error as e:
+                    ryuu_log(f"[TokenCountCache] Could not write to persistent cache: {e}", loglevel="warning")
+
+    def _put_lru(self, key, value):
+        self._lru[key] = value
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.max_entries:
+            self._lru.popitem(last=False)
+
+    def _prune_db(self):
+        # rowid grows with every insert/replace, so the lowest rowids are the oldest entries
+        self._db.execute(
+            "DELETE FROM token_count_results "
+            "WHERE rowid NOT IN (SELECT rowid FROM token_count_results ORDER BY rowid DESC LIMIT ?)",
+            (self.max_db_entries,),
+        )
+        self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            db_entries = None
+            if self._db is not None:
+                db_entries = self._db.execute("SELECT COUNT(*) FROM token_count_results").fetchone()[0]
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_ratio": (self.hits / lookups) if lookups else 0.0,
+                "entries": len(self._lru),
+                "max_entries": self.max_entries,
+                "db_entries": db_entries,
+                "max_db_entries": self.max_db_entries if self._db is not None else None,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._lru.clear()
+            self.hits = self.disk_hits = self.misses = 0
+            if self._db is not None:
+                self._db.execute("DELETE FROM token_count_results")
+                self._db.commit()
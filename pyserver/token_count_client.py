@@ -0,0 +1,68 @@
+import aiohttp
+
+from ..modules.shared.ryuu_log import ryuu_log
+from .admission import LimitExceeded
+
+
+class RemoteTokenCountBackend:
+    """
+    Forwards token counting to the standalone service (token_count_service.py), same functions as token_count_engine.
+    url is e.g. http://127.0.0.1:8190 or unix:/run/ryuu_tokcount.sock
+    """
+
+    def __init__(self, url, timeout=30):
+        self.url = url
+        if url.startswith("unix:"):
+            self._socket_path = url[len("unix:") :]
+            self._base_url = "http://localhost"  # host is ignored with a unix socket
+        else:
+            self._socket_path = None
+            self._base_url = url.rstrip("/")
+        self._timeout = aiohttp.ClientTimeout(total=timeout)
+        self._session = None
+
+    def _get_session(self):
+        # created lazily, a session has to be made inside the running event loop
+        if self._session is None or self._session.closed:
+            if self._socket_path:
+                connector = aiohttp.UnixConnector(path=self._socket_path)
+            else:
+                connector = aiohttp.TCPConnector()
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self._timeout)
+        return self._session
+
+    async def _request(self, method, path, body=None):
+        try:
+            async with self._get_session().request(method, self._base_url + path, json=body) as resp:
+                data = await resp.json()
+        except (aiohttp.ClientError, TimeoutError) as e:
+            ryuu_log(f"[TokenCountService] Request to {self.url} failed: {e!r}", loglevel="error")
+            raise RuntimeError(f"Token count service at {self.url} is not reachable") from e
+        if resp.status >= 400:
+            if "limit" in data:
+                # turned away by the service's own limits, passed on as-is so the frontend can back off
+                raise LimitExceeded.from_json(data, resp.status)
+            raise RuntimeError(data.get("error", f"Token count service returned {resp.status}"))
+        return data
+
+    async def close(self, app=None):
+        # usable as aiohttp on_cleanup callback
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def compute_token_counts(self, **kwargs):
+        return await self._request("POST", "/ryuu/update_token_count", kwargs)
+
+    async def compute_token_counts_batch(self, items):
+        body = {"items": [{"id": item_id, **kwargs} for item_id, kwargs in items]}
+        return (await self._request("POST", "/ryuu/update_token_count_batch", body))["results"]
+
+    async def compute_token_budget(self, **kwargs):
+        return await self._request("POST", "/ryuu/token_budget", kwargs)
+
+    async def cache_stats(self):
+        return await self._request("GET", "/ryuu/token_count_cache/stats")
+
+    async def tokenizers_status(self):
+        return await self._request("GET", "/ryuu/tokenizers/status")
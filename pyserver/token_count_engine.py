@@ -0,0 +1,364 @@
+# Token counting without anything ComfyUI specific: worker threads, result cache, estimates and warm-up.
+# Used by the routes in update_token_count.py and by the standalone service (token_count_service.py)
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from ..modules.shared.prompt_weighting import strip_weighting, strip_weighting_with_map
+from .metrics import TOKENIZER_REQUESTS, register_collector
+from .token_budget import fit_token_budget
+from .token_count_cache import TokenCountCache, make_cache_key
+from .token_counting import count_tokens, count_tokens_batch
+from .token_estimate import TokenEstimator
+from .tokenizer_loader import (
+    DATA_DIR,
+    TOKENIZER_KEYS,
+    get_memory_usage,
+    get_tokenizer,
+    get_tokenizer_aliases,
+    get_tokenizer_lock,
+    get_tokenizer_status,
+    is_tokenizer_failed,
+    is_tokenizer_loaded,
+    load_in_background,
+    resolve_key,
+    start_warmup,
+)
+
+# Tokenizer loading/encoding runs here so the aiohttp event loop (and with it the websocket progress) is never blocked
+# RYUU_TOKENCOUNT_WORKERS can be set to change the amount of worker threads
+_MAX_WORKERS = int(os.environ.get("RYUU_TOKENCOUNT_WORKERS", "") or min(4, os.cpu_count() or 1))
+_executor = ThreadPoolExecutor(max_workers=_MAX_WORKERS, thread_name_prefix="ryuu_tokcount")
+
+
+def _get_cache_db_path():
+    # RYUU_TOKENCOUNT_CACHE_DB can point somewhere else or be set to "off" to keep the cache in memory only
+    db_path = os.environ.get("RYUU_TOKENCOUNT_CACHE_DB", "")
+    if db_path.lower() == "off":
+        return None
+    if db_path:
+        return db_path
+    return DATA_DIR and os.path.join(DATA_DIR, "token_count_cache.sqlite")
+
+
+# Token count results, keyed by the raw (unstripped) text so hits skip strip_weighting too
+_count_cache = TokenCountCache(
+    max_entries=int(os.environ.get("RYUU_TOKENCOUNT_CACHE_SIZE", "") or 2048),
+    db_path=_get_cache_db_path(),
+)
+
+# Load the most used tokenizers in the background so the first count after a restart doesn't block
+_warmup_keys = start_warmup()
+
+# Estimates for tokenizers that are still loading, RYUU_TOKEN_ESTIMATES=off waits for the real count instead
+_estimator = None
+if os.environ.get("RYUU_TOKEN_ESTIMATES", "").lower() != "off":
+    _estimator = TokenEstimator(DATA_DIR and os.path.join(DATA_DIR, "tokenizer_snapshots"))
+
+
+def _split_cold(names):
+    """
+    Splits names into (ready, cold). Cold ones are tokenizers that aren't loaded yet,
+    they get loaded in the background and estimated in the meantime instead of making the request wait.
+    """
+    if _estimator is None:
+        return names, []
+    ready, cold = [], []
+    for name in names:
+        # failed ones go the normal way, so the error shows up like before
+        if is_tokenizer_loaded(name) or is_tokenizer_failed(name):
+            ready.append(name)
+        else:
+            load_in_background(name)
+            cold.append(name)
+    return ready, cold
+
+
+def _save_snapshots(keys):
+    for key in keys:
+        tokenizer = get_tokenizer(key)
+        with get_tokenizer_lock(key):
+            _estimator.save_snapshot(key, tokenizer)
+
+
+def _queue_snapshots(names):
+    """Saves the vocab snapshot of loaded tokenizers that don't have one yet, so later cold starts estimate better."""
+    if _estimator is None:
+        return
+    keys = {resolve_key(name) for name in names}
+    keys = [key for key in keys if key in TOKENIZER_KEYS and _estimator.needs_snapshot(key)]
+    if keys:
+        _executor.submit(_save_snapshots, keys)
+
+
+def _count_requests(names, source):
+    for name in names:
+        key = resolve_key(name)
+        # names come from the client, don't let typos create new label values
+        TOKENIZER_REQUESTS.inc(tokenizer=key if key in TOKENIZER_KEYS else "unknown", source=source)
+
+
+def _collect_metrics():
+    stats = _count_cache.stats()
+    status = get_tokenizer_status()
+    return [
+        ("ryuu_tokencount_cache_hits_total", "counter", "Count cache hits (memory + disk).", [({}, stats["hits"])]),
+        ("ryuu_tokencount_cache_disk_hits_total", "counter", "Count cache hits from the sqlite file.",
+         [({}, stats["disk_hits"])]),
+        ("ryuu_tokencount_cache_misses_total", "counter", "Count cache misses.", [({}, stats["misses"])]),
+        ("ryuu_tokencount_cache_hit_ratio", "gauge", "Count cache hits / lookups.", [({}, stats["hit_ratio"])]),
+        ("ryuu_tokencount_cache_entries", "gauge", "Entries in the in-memory count cache.", [({}, stats["entries"])]),
+        # no public way to get the queue size of a ThreadPoolExecutor
+        ("ryuu_tokencount_executor_queue_depth", "gauge", "Work items waiting for a tokenizer worker thread.",
+         [({}, _executor._work_queue.qsize())]),
+        ("ryuu_tokencount_executor_workers", "gauge", "Tokenizer worker threads.", [({}, _MAX_WORKERS)]),
+        ("ryuu_tokenizer_state", "gauge", "1 for the current load state of every tokenizer.",
+         [({"tokenizer": key, "state": info["state"]}, 1) for key, info in status.items()]),
+        ("ryuu_tokenizer_load_seconds", "gauge", "How long loading took for the loaded tokenizers.",
+         [({"tokenizer": key}, info["load_time"]) for key, info in status.items() if "load_time" in info]),
+        ("ryuu_tokenizer_memory_bytes", "gauge", "Estimated memory of the loaded tokenizers.",
+         [({"tokenizer": key}, info["memory_bytes"]) for key, info in status.items() if info.get("memory_bytes")]),
+    ]  # fmt: skip
+
+
+register_collector(_collect_metrics)
+
+
+def _build_response(names, results):
+    """Response data for one text from {name: count_tokens() result}, in the requested order."""
+    resp_data = {"token_counts": {name: results[name]["count"] for name in names}}
+    chunks = {name: results[name]["chunks"] for name in names if "chunks" in results[name]}
+    if chunks:
+        # CLIP chunk layout with BREAK, e.g. [75, 12, 40]
+        resp_data["chunks"] = chunks
+    approximate = {name: True for name in names if results[name].get("approximate")}
+    if approximate:
+        # estimated while the tokenizer loads, asking again later gets the real count
+        resp_data["approximate"] = approximate
+    tokens = {name: results[name]["tokens"] for name in names if "tokens" in results[name]}
+    if tokens:
+        # include_tokens only, missing for estimates
+        resp_data["tokens"] = tokens
+    return resp_data
+
+
+def _map_token_offsets(tokens, source_map, text_length):
+    """Maps token offsets from the stripped text back to the text as sent, so the client can highlight it directly."""
+    if "starts" not in tokens:
+        return tokens
+    starts = [source_map[start] if start < len(source_map) else text_length for start in tokens["starts"]]
+    ends = [
+        source_map[end - 1] + 1 if end > start else mapped_start
+        for start, end, mapped_start in zip(tokens["starts"], tokens["ends"], starts)
+    ]
+    return {"pieces": tokens["pieces"], "starts": starts, "ends": ends}
+
+
+async def compute_token_counts(
+    text,
+    tok_types,
+    add_special_tokens=False,
+    support_break_keyword=False,
+    node_key=None,
+    include_tokens=False,
+    allow_estimates=True,
+):
+    """
+    Counts text for every tokenizer in tok_types without blocking the event loop, returns the response data.
+    include_tokens adds the token strings and their offsets in text, from the same encode call as the count.
+    allow_estimates=False waits for tokenizers that are still loading instead of estimating (node execution).
+    """
+    # dedupe while keeping order
+    names = list(dict.fromkeys(tok_types))
+    results = {}
+    loop = asyncio.get_running_loop()
+
+    # cache lookup can touch the sqlite file, so it runs in the executor too
+    # raw token strings aren't cached, so skip the cache entirely when they're wanted
+    keys = {name: make_cache_key(text, name, add_special_tokens, support_break_keyword) for name in names}
+    if not include_tokens:
+        cached = await loop.run_in_executor(_executor, lambda: {name: _count_cache.get(keys[name]) for name in names})
+        results = {name: result for name, result in cached.items() if result is not None}
+        _count_requests(results, "cache")
+    missing = [name for name in names if name not in results]
+
+    if missing:
+        source_map = None
+        if include_tokens:
+            stripped_text, source_map = await loop.run_in_executor(_executor, strip_weighting_with_map, text)
+        else:
+            stripped_text = await loop.run_in_executor(_executor, strip_weighting, text)
+        ready, cold = _split_cold(missing) if allow_estimates else (missing, [])
+        _count_requests(ready, "tokenizer")
+        _count_requests(cold, "estimate")
+
+        # every tokenizer runs concurrently in the executor
+        counted = await asyncio.gather(
+            *(
+                loop.run_in_executor(
+                    _executor,
+                    count_tokens,
+                    name,
+                    stripped_text,
+                    add_special_tokens,
+                    support_break_keyword,
+                    node_key,
+                    include_tokens,
+                )
+                for name in ready
+            ),
+            *(
+                loop.run_in_executor(
+                    _executor,
+                    _estimator.estimate,
+                    resolve_key(name),
+                    stripped_text,
+                    add_special_tokens,
+                    support_break_keyword,
+                )
+                for name in cold
+            ),
+        )
+        results.update(zip(ready + cold, counted))
+        if include_tokens:
+            for name in ready:
+                if "tokens" in results[name]:
+                    results[name]["tokens"] = _map_token_offsets(results[name]["tokens"], source_map, len(text))
+        else:
+            await loop.run_in_executor(
+                _executor, lambda: [_count_cache.put(keys[name], results[name]) for name in missing]
+            )
+        _queue_snapshots(ready)
+
+    return _build_response(names, results)
+
+
+async def compute_token_counts_batch(items):
+    """
+    Counts many texts at once, items are (id, kwargs for compute_token_counts).
+    Work is grouped by tokenizer and settings so each group is a single batch encode.
+    Returns {id: response data like compute_token_counts}.
+    """
+    loop = asyncio.get_running_loop()
+
+    # items that want the token strings (not cached) or no estimates are counted on their own
+    def is_separate(kwargs):
+        return kwargs.get("include_tokens") or not kwargs.get("allow_estimates", True)
+
+    all_items = items
+    separate = [(item_id, kwargs) for item_id, kwargs in items if is_separate(kwargs)]
+    if separate:
+        items = [(item_id, kwargs) for item_id, kwargs in items if not is_separate(kwargs)]
+        separate_responses = asyncio.gather(*(compute_token_counts(**kwargs) for _, kwargs in separate))
+
+    def lookup():
+        # (item id, tokenizer name) -> cached result, for everything in one executor call
+        found = {}
+        for item_id, kwargs in items:
+            for name in dict.fromkeys(kwargs["tok_types"]):
+                result = _count_cache.get(
+                    make_cache_key(kwargs["text"], name, kwargs["add_special_tokens"], kwargs["support_break_keyword"])
+                )
+                if result is not None:
+                    found[item_id, name] = result
+        return found
+
+    results = await loop.run_in_executor(_executor, lookup)
+    _count_requests([name for _, name in results], "cache")
+
+    # group the misses: (name, add_special_tokens, support_break_keyword) -> {raw text: [item ids]}
+    # so nodes sharing the same text are only counted once
+    groups = {}
+    for item_id, kwargs in items:
+        for name in dict.fromkeys(kwargs["tok_types"]):
+            if (item_id, name) not in results:
+                group = (name, bool(kwargs["add_special_tokens"]), bool(kwargs["support_break_keyword"]))
+                groups.setdefault(group, {}).setdefault(kwargs["text"], []).append(item_id)
+
+    if groups:
+        raw_texts = list({text for texts in groups.values() for text in texts})
+        stripped_texts = await loop.run_in_executor(_executor, lambda: [strip_weighting(text) for text in raw_texts])
+        stripped = dict(zip(raw_texts, stripped_texts))
+
+        def estimate_batch(name, texts, special, break_kw):
+            return [_estimator.estimate(resolve_key(name), text, special, break_kw) for text in texts]
+
+        group_keys = list(groups)
+        ready, _ = _split_cold(list({name for name, _, _ in group_keys}))
+        counted = await asyncio.gather(
+            *(
+                loop.run_in_executor(
+                    _executor,
+                    count_tokens_batch if name in ready else estimate_batch,
+                    name,
+                    [stripped[text] for text in groups[name, special, break_kw]],
+                    special,
+                    break_kw,
+                )
+                for name, special, break_kw in group_keys
+            )
+        )
+
+        to_cache = []
+        for group, group_results in zip(group_keys, counted):
+            name, special, break_kw = group
+            for (text, item_ids), result in zip(groups[group].items(), group_results):
+                _count_requests([name] * len(item_ids), "tokenizer" if name in ready else "estimate")
+                for item_id in item_ids:
+                    results[item_id, name] = result
+                to_cache.append((make_cache_key(text, name, special, break_kw), result))
+        await loop.run_in_executor(_executor, lambda: [_count_cache.put(key, result) for key, result in to_cache])
+        _queue_snapshots(ready)
+
+    # build response per item, same shape as the single route
+    response = {}
+    for item_id, kwargs in items:
+        names = list(dict.fromkeys(kwargs["tok_types"]))
+        response[item_id] = _build_response(names, {name: results[item_id, name] for name in names})
+    if separate:
+        response.update(zip([item_id for item_id, _ in separate], await separate_responses))
+        response = {item_id: response[item_id] for item_id, _ in all_items}
+    return response
+
+
+async def compute_token_budget(
+    text, tok_types, budget, mode="prefix", add_special_tokens=False, support_break_keyword=False
+):
+    """
+    Where to cut text so it fits in budget tokens for every tokenizer in tok_types, see fit_token_budget().
+    Returns {"cut": tightest cut, "tokenizer": the one that needs it, "fits": nothing had to be cut,
+    "cuts": {name: fit_token_budget() result}}.
+    """
+    names = list(dict.fromkeys(tok_types))
+    loop = asyncio.get_running_loop()
+    _count_requests(names, "budget")
+    fitted = await asyncio.gather(
+        *(
+            loop.run_in_executor(
+                _executor, fit_token_budget, name, text, budget, mode, add_special_tokens, support_break_keyword
+            )
+            for name in names
+        )
+    )
+    cuts = dict(zip(names, fitted))
+    known = [name for name in names if cuts[name] is not None]
+    tightest = min(known, key=lambda name: cuts[name]["cut"], default=None)
+    return {
+        "cut": cuts[tightest]["cut"] if tightest else len(text),
+        "tokenizer": tightest,
+        "fits": all(cuts[name]["fits"] for name in known),
+        "cuts": cuts,
+    }
+
+
+async def cache_stats():
+    return await asyncio.get_running_loop().run_in_executor(_executor, _count_cache.stats)
+
+
+async def tokenizers_status():
+    return {
+        "tokenizers": get_tokenizer_status(),
+        "aliases": get_tokenizer_aliases(),
+        "warmup": _warmup_keys,
+        "memory": get_memory_usage(),
+    }
@@ -0,0 +1,280 @@
+import asyncio
+import json
+import re
+
+from aiohttp import web
+
+from ..modules.shared.ryuu_log import ryuu_log
+from .admission import (
+    ClientLimiter,
+    LimitExceeded,
+    check_batch_size,
+    check_body_size,
+    check_payload,
+)
+from .metrics import HTTP_REQUEST_BYTES, HTTP_REQUESTS, render_metrics, track_route
+
+# "prefix" cuts after any token, "tags" only before a comma (see token_budget.py)
+BUDGET_MODES = ("prefix", "tags")
+
+# the overlay sends "id" and "seq" first, so frames that are too big or broken to parse can still be answered
+_FRAME_ID_PATTERN = re.compile(r'^\s*\{\s*"id"\s*:\s*"((?:[^"\\]|\\.)*)"\s*,\s*"seq"\s*:\s*(\d+)')
+
+
+def _frame_ids(raw):
+    """(id, seq) from the start of a raw websocket frame, ("", None) if they aren't there."""
+    match = _FRAME_ID_PATTERN.match(raw[:512])
+    if match is None:
+        return "", None
+    return json.loads(f'"{match.group(1)}"'), int(match.group(2))
+
+
+def parse_count_request(data):
+    """
+    Validates a token count request body, shared by the HTTP route and the websocket.
+    Returns (kwargs for compute_token_counts, None) or (None, error message), raises LimitExceeded if it's too big.
+    """
+    if not isinstance(data, dict):
+        return None, "Invalid JSON"
+    text = data.get("text", "")
+    if not text:
+        return None, "No text provided"
+    check_payload(text, data.get("tok_types") or [])
+
+    # optional, identifies the client + node the text comes from for incremental counting
+    node_key = data.get("node_key")
+    return {
+        "text": text,
+        "tok_types": data.get("tok_types") or [],
+        "add_special_tokens": data.get("add_special_tokens", False),
+        "support_break_keyword": data.get("support_break_keyword", False),
+        "node_key": str(node_key) if node_key is not None else None,
+        # opt-in, adds {"tokens": {name: {"pieces", "starts", "ends"}}} to the response, offsets are into text
+        "include_tokens": bool(data.get("include_tokens", False)),
+        # false waits for tokenizers that are still loading instead of getting an estimate
+        "allow_estimates": bool(data.get("allow_estimates", True)),
+    }, None
+
+
+def parse_budget_request(data):
+    """Like parse_count_request() for /ryuu/token_budget, returns (kwargs for compute_token_budget, error)."""
+    if not isinstance(data, dict):
+        return None, "Invalid JSON"
+    text = data.get("text", "")
+    if not text:
+        return None, "No text provided"
+    budget = data.get("budget")
+    if not isinstance(budget, int) or isinstance(budget, bool) or budget < 0:
+        return None, "budget has to be a positive integer"
+    mode = data.get("mode", "prefix")
+    if mode not in BUDGET_MODES:
+        return None, f"mode has to be one of {', '.join(BUDGET_MODES)}"
+    check_payload(text, data.get("tok_types") or [])
+
+    return {
+        "text": text,
+        "tok_types": data.get("tok_types") or [],
+        "budget": budget,
+        "mode": mode,
+        "add_special_tokens": data.get("add_special_tokens", False),
+        "support_break_keyword": data.get("support_break_keyword", False),
+    }, None
+
+
+def _limit_response(e):
+    return web.json_response(e.to_json(), status=e.status, headers=e.headers())
+
+
+async def _read_json(request):
+    """Request body as JSON, None if it isn't valid. Raises LimitExceeded before reading a body that's too large."""
+    check_body_size(request.content_length)
+    try:
+        return await request.json()
+    except Exception:
+        return None
+
+
+def add_token_count_routes(routes, backend, limit_clients=True):
+    """
+    Registers the token count routes on an aiohttp RouteTableDef.
+    backend does the actual work, either token_count_engine (counts in this process)
+    or a RemoteTokenCountBackend (forwards to the standalone service), both have the same async functions:
+    compute_token_counts(**kwargs), compute_token_counts_batch(items), compute_token_budget(**kwargs),
+    cache_stats() and tokenizers_status().
+    Counting routes are limited per client (see admission.py), turned away requests get a response with
+    "limit" (why) and "retry_after" (seconds, if trying again later helps) so the frontend can back off.
+    limit_clients=False turns the per client limit off, for the standalone service where every request comes from
+    a ComfyUI instance (that already limits its own clients) and not from a browser.
+    """
+    limiter = ClientLimiter(enabled=limit_clients)
+
+    @routes.post("/ryuu/update_token_count")
+    @track_route("update_token_count")
+    async def update_token_count(request):
+        try:
+            async with limiter.slot(request.remote):
+                data = await _read_json(request)
+                if data is None:
+                    return web.json_response({"error": "Invalid JSON"}, status=400)
+
+                kwargs, error = parse_count_request(data)
+                if error:
+                    return web.json_response({"error": error}, status=400)
+
+                return web.json_response(await backend.compute_token_counts(**kwargs))
+        except LimitExceeded as e:
+            return _limit_response(e)
+
+    @routes.post("/ryuu/update_token_count_batch")
+    @track_route("update_token_count_batch")
+    async def update_token_count_batch(request):
+        """
+        Body: {"items": [{"id", "text", "tok_types", "add_special_tokens", "support_break_keyword"}, ...]}
+        (every item can have the other fields of /ryuu/update_token_count too)
+        Returns {"results": {id: {"token_counts": ...} or {"error": ...}}}
+        """
+        try:
+            async with limiter.slot(request.remote):
+                data = await _read_json(request)
+                if data is None:
+                    return web.json_response({"error": "Invalid JSON"}, status=400)
+
+                raw_items = data.get("items") if isinstance(data, dict) else None
+                if not isinstance(raw_items, list):
+                    return web.json_response({"error": "No items provided"}, status=400)
+                check_batch_size(len(raw_items))
+
+                items = []
+                response = {}
+                for index, raw_item in enumerate(raw_items):
+                    item_id = str(raw_item.get("id", index)) if isinstance(raw_item, dict) else str(index)
+                    try:
+                        kwargs, error = parse_count_request(raw_item)
+                    except LimitExceeded as e:
+                        response[item_id] = e.to_json()
+                        continue
+                    if error:
+                        response[item_id] = {"error": error}
+                    else:
+                        items.append((item_id, kwargs))
+
+                if items:
+                    response.update(await backend.compute_token_counts_batch(items))
+                return web.json_response({"results": response})
+        except LimitExceeded as e:
+            return _limit_response(e)
+
+    @routes.post("/ryuu/token_budget")
+    @track_route("token_budget")
+    async def token_budget(request):
+        """
+        Body: {"text", "tok_types", "budget", "mode" ("prefix" or "tags"), "add_special_tokens",
+        "support_break_keyword"}. Returns where to cut text so it fits in budget tokens for all tok_types,
+        see compute_token_budget().
+        """
+        try:
+            async with limiter.slot(request.remote):
+                data = await _read_json(request)
+                if data is None:
+                    return web.json_response({"error": "Invalid JSON"}, status=400)
+
+                kwargs, error = parse_budget_request(data)
+                if error:
+                    return web.json_response({"error": error}, status=400)
+
+                return web.json_response(await backend.compute_token_budget(**kwargs))
+        except LimitExceeded as e:
+            return _limit_response(e)
+
+    @routes.get("/ryuu/token_count_ws")
+    async def token_count_ws(request):
+        """
+        Websocket alternative to /ryuu/update_token_count for the overlay.
+        Client sends the same JSON as the HTTP route plus "id" (node id) and "seq" (increasing per id).
+        Work for an id is cancelled as soon as a newer text for it arrives, so only the latest counts get pushed back
+        as {"id", "seq", "token_counts"} (or {"id", "seq", "error"}).
+        """
+        ws = web.WebSocketResponse(heartbeat=30)
+        await ws.prepare(request)
+
+        tasks = {}  # id -> task counting the latest text for it
+
+        async def run(msg_id, seq, kwargs):
+            try:
+                async with limiter.slot(request.remote):
+                    resp_data = await backend.compute_token_counts(**kwargs)
+            except asyncio.CancelledError:
+                raise
+            except LimitExceeded as e:
+                resp_data = e.to_json()
+            except Exception as e:
+                ryuu_log(f"[TokenCountWS] Counting failed: {e}", loglevel="error")
+                resp_data = {"error": str(e)}
+            if not ws.closed:
+                await ws.send_json({"id": msg_id, "seq": seq, **resp_data})
+
+        try:
+            async for msg in ws:
+                if msg.type != web.WSMsgType.TEXT:
+                    continue
+                HTTP_REQUESTS.inc(route="token_count_ws", status="message")
+                HTTP_REQUEST_BYTES.observe(len(msg.data), route="token_count_ws")
+                try:
+                    check_body_size(len(msg.data))
+                except LimitExceeded as e:
+                    msg_id, seq = _frame_ids(msg.data)
+                    await ws.send_json({"id": msg_id, "seq": seq, **e.to_json()})
+                    continue
+                try:
+                    data = msg.json()
+                except ValueError:
+                    msg_id, seq = _frame_ids(msg.data)
+                    await ws.send_json({"id": msg_id, "seq": seq, "error": "Invalid JSON"})
+                    continue
+                msg_id = str(data.get("id", "")) if isinstance(data, dict) else ""
+                seq = data.get("seq") if isinstance(data, dict) else None
+
+                try:
+                    kwargs, error = parse_count_request(data)
+                except LimitExceeded as e:
+                    await ws.send_json({"id": msg_id, "seq": seq, **e.to_json()})
+                    continue
+                if error:
+                    await ws.send_json({"id": msg_id, "seq": seq, "error": error})
+                    continue
+
+                # superseded: whatever hasn't started in the executor yet is dropped, running parts finish unseen
+                previous = tasks.get(msg_id)
+                if previous is not None and not previous.done():
+                    previous.cancel()
+                task = asyncio.ensure_future(run(msg_id, seq, kwargs))
+                tasks[msg_id] = task
+
+                def forget(t, msg_id=msg_id):
+                    if tasks.get(msg_id) is t:
+                        del tasks[msg_id]
+
+                task.add_done_callback(forget)
+        finally:
+            for task in tasks.values():
+                task.cancel()
+
+        return ws
+
+    @routes.get("/ryuu/token_count_cache/stats")
+    async def token_count_cache_stats(request):
+        return web.json_response(await backend.cache_stats())
+
+    @routes.get("/ryuu/tokenizers/status")
+    async def tokenizers_status(request):
+        return web.json_response(await backend.tokenizers_status())
+
+    @routes.get("/ryuu/metrics")
+    async def metrics(request):
+        """
+        Prometheus text format. Only covers this process, with RYUU_TOKENCOUNT_SERVICE set
+        the tokenizer/cache metrics are on the service's own /ryuu/metrics.
+        """
+        # collectors read the sqlite cache, keep that off the event loop
+        text = await asyncio.get_running_loop().run_in_executor(None, render_metrics)
+        return web.Response(text=text, headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
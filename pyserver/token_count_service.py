@@ -0,0 +1,48 @@
+import argparse
+import os
+import stat
+
+from aiohttp import web
+
+from ..modules.shared.ryuu_log import ryuu_log
+from .token_count_routes import add_token_count_routes
+
+
+def create_app():
+    # imported here so RYUU_DATA_DIR set by main() is seen when the tokenizers/caches get set up
+    from . import token_count_engine
+
+    routes = web.RouteTableDef()
+    # all requests come from the local ComfyUI instances, the per client limits are applied there
+    add_token_count_routes(routes, token_count_engine, limit_clients=False)
+    app = web.Application()
+    app.add_routes(routes)
+    return app
+
+
+def main(argv=None):
+    """
+    Standalone token count service, so several ComfyUI instances on one host share one set of loaded tokenizers.
+    ComfyUI forwards to it when RYUU_TOKENCOUNT_SERVICE is set (see update_token_count.py).
+    Run it with extras/token_count_service.py, all RYUU_TOKENIZER_*/RYUU_TOKENCOUNT_* variables apply here too.
+    """
+    parser = argparse.ArgumentParser(description="RyuuNoodles token count service")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8190)
+    parser.add_argument("--unix", default=None, help="listen on this unix socket instead of host/port")
+    parser.add_argument("--data-dir", default=None, help="where the count cache, snapshots and tokenizers.json live")
+    args = parser.parse_args(argv)
+
+    if args.data_dir:
+        os.environ["RYUU_DATA_DIR"] = os.path.abspath(args.data_dir)
+
+    app = create_app()
+    if args.unix:
+        # socket file left over from a previous run would make binding fail
+        if os.path.exists(args.unix) and stat.S_ISSOCK(os.stat(args.unix).st_mode):
+            os.unlink(args.unix)
+        ryuu_log(f"[TokenCountService] Listening on unix:{args.unix}", loglevel="info")
+        web.run_app(app, path=args.unix, print=None)
+    else:
+        ryuu_log(f"[TokenCountService] Listening on http://{args.host}:{args.port}", loglevel="info")
+        web.run_app(app, host=args.host, port=args.port, print=None)
@@ -0,0 +1,202 @@
+import re
+import time
+
+from .incremental_token_count import IncrementalTokenCounter
+from .metrics import TOKENIZER_ENCODE_SECONDS
+from .tokenizer_loader import get_tokenizer, get_tokenizer_lock, resolve_key
+
+# Handles BREAK at start, end, or surrounded by any whitespace
+BREAK_PATTERN = re.compile(r"(?<!\w)BREAK(?!\w)")
+CLIP_CHUNK_SIZE = 75
+
+# Last segmentation per node, so small edits only re-tokenize what changed
+_incremental_counter = IncrementalTokenCounter()
+
+
+def _num_tokens(tokenizer, text):
+    # plain lists, building a torch tensor just to read its length is wasted work
+    return len(tokenizer(text, add_special_tokens=False)["input_ids"])
+
+
+def count_break_segments(text, tokenizer):
+    """
+    Token count (without special tokens) of every BREAK separated segment of text with a single tokenizer call.
+    Fast tokenizers encode the full text once and the tokens are assigned to segments by their offsets,
+    slow ones have no offsets so they get all segments in one batch.
+    """
+    breaks = [match.span() for match in BREAK_PATTERN.finditer(text)]
+    if not breaks:
+        return [_num_tokens(tokenizer, text)]
+
+    if getattr(tokenizer, "is_fast", False):
+        encoding = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)
+        counts = [0] * (len(breaks) + 1)
+        for segment in _token_segments(encoding["offset_mapping"], breaks):
+            if segment is not None:
+                counts[segment] += 1
+        return counts
+
+    segments = BREAK_PATTERN.split(text)
+    return [len(ids) for ids in tokenizer(segments, add_special_tokens=False)["input_ids"]]
+
+
+def _token_segments(offsets, breaks):
+    """Segment index of every token by its offset, None for tokens of the BREAK keyword itself."""
+    segments = []
+    segment = 0
+    for start, _ in offsets:
+        while segment < len(breaks) and start >= breaks[segment][1]:
+            segment += 1
+        if segment < len(breaks) and start >= breaks[segment][0]:
+            segments.append(None)
+        else:
+            segments.append(segment)
+    return segments
+
+
+def encode_tokens(text, tokenizer, split_breaks=False):
+    """
+    Token strings of text (without special tokens) and their char offsets from a single encode call.
+    Returns (tokens, segment_counts) with tokens as parallel lists {"pieces", "starts", "ends"} so the response
+    stays small, slow tokenizers have no offsets so only "pieces" is there for them.
+    With split_breaks the BREAK keywords are left out and segment_counts is like count_break_segments(), else None.
+    """
+    breaks = [match.span() for match in BREAK_PATTERN.finditer(text)] if split_breaks else []
+
+    if getattr(tokenizer, "is_fast", False):
+        encoding = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)
+        ids = encoding["input_ids"]
+        offsets = encoding["offset_mapping"]
+        segment_counts = None
+        if split_breaks:
+            segment_counts = [0] * (len(breaks) + 1)
+            keep = []
+            for i, segment in enumerate(_token_segments(offsets, breaks)):
+                if segment is not None:
+                    segment_counts[segment] += 1
+                    keep.append(i)
+            if len(keep) < len(ids):
+                ids = [ids[i] for i in keep]
+                offsets = [offsets[i] for i in keep]
+        tokens = {
+            # one call for the whole list, not one per token
+            "pieces": tokenizer.convert_ids_to_tokens(ids),
+            "starts": [start for start, _ in offsets],
+            "ends": [end for _, end in offsets],
+        }
+        return tokens, segment_counts
+
+    if split_breaks:
+        segment_ids = tokenizer(BREAK_PATTERN.split(text), add_special_tokens=False)["input_ids"]
+        ids = [token_id for seg in segment_ids for token_id in seg]
+        segment_counts = [len(seg) for seg in segment_ids]
+    else:
+        ids = tokenizer(text, add_special_tokens=False)["input_ids"]
+        segment_counts = None
+    return {"pieces": tokenizer.convert_ids_to_tokens(ids)}, segment_counts
+
+
+def clip_chunk_layout(segment_counts, chunk_size=CLIP_CHUNK_SIZE):
+    """
+    Number of tokens in every CLIP chunk. Each BREAK starts a new chunk
+    and a segment longer than chunk_size overflows into as many extra chunks as needed.
+    E.g. segment counts [80, 10] -> [75, 5, 10]
+    """
+    layout = []
+    for count in segment_counts:
+        full, rest = divmod(count, chunk_size)
+        layout.extend([chunk_size] * full)
+        if rest or not full:
+            layout.append(rest)
+    return layout
+
+
+def handle_clip_l_breaks(text, tokenizer, add_special_tokens=False, segment_counts=None):
+    """
+    Handle BREAK keywords for CLIP-L tokenizer with 75-token chunking.
+    Every chunk but the last is padded to 75 tokens. Returns (count, chunk layout).
+    """
+    if segment_counts is None:
+        segment_counts = count_break_segments(text, tokenizer)
+    layout = clip_chunk_layout(segment_counts)
+    specials = tokenizer.num_special_tokens_to_add() if add_special_tokens else 0
+    return CLIP_CHUNK_SIZE * (len(layout) - 1) + layout[-1] + specials, layout
+
+
+def count_tokens(
+    name, text, add_special_tokens=False, support_break_keyword=False, node_key=None, include_tokens=False
+):
+    """
+    Blocking token count for a single tokenizer, meant to be run inside an executor.
+    Returns {"count": int or None, "chunks": CLIP chunk layout (BREAK mode only), "tokens": see encode_tokens()}.
+    With include_tokens the count comes from the same encode call as the tokens.
+    If node_key is given the count is done incrementally against the last text seen for that node.
+    """
+    tokenizer = get_tokenizer(name)
+    if tokenizer is None:
+        return {"count": None}
+
+    key = resolve_key(name)
+    result = {}
+    with get_tokenizer_lock(key):
+        start = time.perf_counter()
+        specials = tokenizer.num_special_tokens_to_add() if add_special_tokens else 0
+
+        def incremental_count(state_key, chunk):
+            return _incremental_counter.count(state_key, chunk, lambda window: _num_tokens(tokenizer, window))
+
+        clip_breaks = key == "clip_l" and support_break_keyword
+        if include_tokens:
+            # full encode anyway, so no incremental counting here
+            # For CLIP-L with BREAK, this won't show the padding tokens, just the actual text tokens
+            result["tokens"], segment_counts = encode_tokens(text, tokenizer, split_breaks=clip_breaks)
+            if clip_breaks:
+                result["count"], result["chunks"] = handle_clip_l_breaks(
+                    text, tokenizer, add_special_tokens, segment_counts=segment_counts
+                )
+            else:
+                result["count"] = specials + len(result["tokens"]["pieces"])
+        # Special handling for CLIP-L tokenizer with BREAK keywords
+        elif clip_breaks:
+            segment_counts = None
+            if node_key is not None:
+                segment_counts = [
+                    incremental_count((node_key, key, "break", i), segment)
+                    for i, segment in enumerate(BREAK_PATTERN.split(text))
+                ]
+            result["count"], result["chunks"] = handle_clip_l_breaks(
+                text, tokenizer, add_special_tokens, segment_counts=segment_counts
+            )
+        elif node_key is not None:
+            result["count"] = specials + incremental_count((node_key, key), text)
+        else:
+            # Standard tokenization for other tokenizers
+            result["count"] = specials + _num_tokens(tokenizer, text)
+
+        TOKENIZER_ENCODE_SECONDS.observe(time.perf_counter() - start, tokenizer=key, call="single")
+    return result
+
+
+def count_tokens_batch(name, texts, add_special_tokens=False, support_break_keyword=False):
+    """
+    count_tokens() for many texts with the same settings. Plain counts are done with a single batch encode call,
+    which fast tokenizers run in parallel in Rust and which saves the per call overhead for slow ones.
+    """
+    tokenizer = get_tokenizer(name)
+    if tokenizer is None:
+        return [{"count": None} for _ in texts]
+
+    key = resolve_key(name)
+    with get_tokenizer_lock(key):
+        start = time.perf_counter()
+        if key == "clip_l" and support_break_keyword:
+            results = []
+            for text in texts:
+                count, chunks = handle_clip_l_breaks(text, tokenizer, add_special_tokens)
+                results.append({"count": count, "chunks": chunks})
+        else:
+            specials = tokenizer.num_special_tokens_to_add() if add_special_tokens else 0
+            all_ids = tokenizer(list(texts), add_special_tokens=False)["input_ids"]
+            results = [{"count": specials + len(ids)} for ids in all_ids]
+        TOKENIZER_ENCODE_SECONDS.observe(time.perf_counter() - start, tokenizer=key, call="batch")
+    return results
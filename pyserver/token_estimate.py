@@ -0,0 +1,169 @@
+import gzip
+import math
+import os
+import re
+import threading
+
+from ..modules.shared.ryuu_log import ryuu_log
+from .token_counting import BREAK_PATTERN, CLIP_CHUNK_SIZE, clip_chunk_layout
+from .tokenizer_loader import get_tokenizer_family
+
+# rough stand-in for the real pre-tokenizers: letter runs, digit runs and single punctuation characters
+_PRETOKENIZE_PATTERN = re.compile(r"[^\W\d_]+|\d+|[^\w\s]|_")
+# markers tokenizers put on vocab pieces for word boundaries: CLIP "</w>", SentencePiece "▁", byte level BPE "Ġ"
+_PIECE_MARKERS = ("</w>", "▁", "Ġ")
+_MAX_PIECE_LEN = 16
+
+# Fallback rules per tokenizer family for when there's no vocab snapshot yet:
+# lowercase: tokenizer lowercases input, word_len: letters a word has to exceed before it's split,
+# chars_per_token: average length of the pieces longer words are split into,
+# digit_group: digits per token, specials: tokens added with add_special_tokens
+_FAMILIES = {
+    "clip": {"lowercase": True, "word_len": 8, "chars_per_token": 4.0, "digit_group": 1, "specials": 2},
+    "sentencepiece": {"lowercase": False, "word_len": 7, "chars_per_token": 3.5, "digit_group": 2, "specials": 1},
+    "gemma": {"lowercase": False, "word_len": 9, "chars_per_token": 4.5, "digit_group": 1, "specials": 1},
+    "llama3": {"lowercase": False, "word_len": 8, "chars_per_token": 4.0, "digit_group": 3, "specials": 1},
+    "qwen": {"lowercase": False, "word_len": 8, "chars_per_token": 4.0, "digit_group": 1, "specials": 0},
+}
+
+# tokenizer key -> family, unknown keys use "sentencepiece" unless the tokenizer config sets one
+TOKENIZER_FAMILIES = {
+    "clip_l": "clip",
+    "t5": "sentencepiece",
+    "t5_fast": "sentencepiece",
+    "umt5": "sentencepiece",
+    "auraflow": "sentencepiece",
+    "gemma2": "gemma",
+    "gemma3": "gemma",
+    "llama3": "llama3",
+    "qwen25vl": "qwen",
+}
+
+
+class TokenEstimator:
+    """
+    Cheap token count estimates for tokenizers that aren't loaded yet, so the overlay has something to show
+    on a cold start. Once a real tokenizer was loaded its vocabulary is saved as a snapshot (one piece per line,
+    gzipped) to snapshot_dir. With a snapshot words are split by greedy longest match against the vocabulary,
+    without one a per family rule is used.
+    Neither is exact, extras/measure_token_estimate_error.py shows how far off they are.
+    """
+
+    def __init__(self, snapshot_dir=None):
+        self.snapshot_dir = snapshot_dir
+        self._snapshots = {}  # key -> (pieces set or None, specials or None)
+        self._saved = set()  # keys that have a snapshot file or where writing one was tried during this run
+        self._lock = threading.Lock()
+
+    def _snapshot_path(self, key):
+        return os.path.join(self.snapshot_dir, f"{key}.txt.gz")
+
+    def _get_snapshot(self, key):
+        with self._lock:
+            if key in self._snapshots:
+                return self._snapshots[key]
+
+        pieces, specials = None, None
+        if self.snapshot_dir and os.path.isfile(self._snapshot_path(key)):
+            try:
+                with gzip.open(self._snapshot_path(key), "rt", encoding="utf-8") as f:
+                    specials = int(f.readline().strip() or 0)
+                    pieces = {line.rstrip("\n") for line in f}
+            except (OSError, ValueError) as e:
+                ryuu_log(f"[TokenEstimator] Could not read vocab snapshot for {key}: {e}", loglevel="warning")
+                pieces, specials = None, None
+
+        with self._lock:
+            self._snapshots[key] = (pieces, specials)
+        return pieces, specials
+
+    def needs_snapshot(self, key):
+        if not self.snapshot_dir:
+            return False
+        with self._lock:
+            if key in self._saved:
+                return False
+        if os.path.isfile(self._snapshot_path(key)):
+            with self._lock:
+                self._saved.add(key)
+            return False
+        return True
+
+    def save_snapshot(self, key, tokenizer):
+        """Writes the vocab snapshot for key from a loaded tokenizer, meant to be run inside an executor."""
+        with self._lock:
+            if key in self._saved:
+                return
+            self._saved.add(key)
+
+        try:
+            pieces = set()
+            for piece in tokenizer.get_vocab():
+                for marker in _PIECE_MARKERS:
+                    piece = piece.replace(marker, "")
+                if piece and len(piece) <= _MAX_PIECE_LEN and "\n" not in piece:
+                    pieces.add(piece)
+            specials = tokenizer.num_special_tokens_to_add()
+
+            os.makedirs(self.snapshot_dir, exist_ok=True)
+            tmp_path = self._snapshot_path(key) + ".tmp"
+            with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+                f.write(f"{specials}\n")
+                f.write("\n".join(sorted(pieces)))
+            os.replace(tmp_path, self._snapshot_path(key))
+        except Exception as e:
+            ryuu_log(f"[TokenEstimator] Could not save vocab snapshot for {key}: {e}", loglevel="warning")
+            return
+
+        with self._lock:
+            self._snapshots[key] = (pieces, specials)
+        ryuu_log(f"[TokenEstimator] Saved vocab snapshot for {key} ({len(pieces)} pieces).", loglevel="debug")
+
+    def _count(self, text, family, pieces):
+        if family["lowercase"]:
+            text = text.lower()
+
+        count = 0
+        for word in _PRETOKENIZE_PATTERN.findall(text):
+            if word[0].isdigit():
+                count += math.ceil(len(word) / family["digit_group"])
+            elif len(word) == 1:
+                count += 1
+            elif pieces is not None:
+                # greedy longest match, characters without any piece count as one token each
+                i = 0
+                while i < len(word):
+                    length = min(_MAX_PIECE_LEN, len(word) - i)
+                    while length > 1 and word[i : i + length] not in pieces:
+                        length -= 1
+                    count += 1
+                    i += length
+            elif not word.isascii():
+                count += len(word)
+            elif len(word) <= family["word_len"]:
+                count += 1
+            else:
+                count += math.ceil(len(word) / family["chars_per_token"])
+        return count
+
+    def estimate(self, key, text, add_special_tokens=False, support_break_keyword=False):
+        """
+        Same result shape as token_counting.count_tokens() plus "approximate": True.
+        key has to be a resolved tokenizer key.
+        """
+        family_name = get_tokenizer_family(key) or TOKENIZER_FAMILIES.get(key, "sentencepiece")
+        family = _FAMILIES.get(family_name, _FAMILIES["sentencepiece"])
+        pieces, specials = self._get_snapshot(key)
+        if specials is None:
+            specials = family["specials"]
+        specials = specials if add_special_tokens else 0
+
+        result = {"approximate": True}
+        if key == "clip_l" and support_break_keyword:
+            segment_counts = [self._count(segment, family, pieces) for segment in BREAK_PATTERN.split(text)]
+            layout = clip_chunk_layout(segment_counts)
+            result["count"] = CLIP_CHUNK_SIZE * (len(layout) - 1) + layout[-1] + specials
+            result["chunks"] = layout
+        else:
+            result["count"] = self._count(text, family, pieces) + specials
+        return result
@@ -0,0 +1,101 @@
+import hashlib
+import json
+import os
+
+import tokenizers
+import transformers
+from transformers import PreTrainedTokenizerFast
+from transformers.convert_slow_tokenizer import convert_slow_tokenizer
+
+from ..modules.shared.ryuu_log import ryuu_log
+
+# prompts a converted tokenizer has to give the exact same ids for as the slow one, covers the usual prompt styles
+# plus the things conversions tend to get wrong (whitespace runs, unicode normalization, apostrophes, digits)
+PARITY_TEXTS = [
+    "masterpiece, best quality, 1girl, solo, looking at viewer, smile, long hair, blue sky",
+    "score_9, score_8_up, score_7_up, source_anime, rating_safe",
+    "A photograph of an astronaut riding a horse on the surface of the moon.",
+    "an old man's hat, it's raining, they're  walking   home\tat night\n\nwet street",
+    "BREAK, BREAKING news BREAK cityscape",
+    "(detailed background:1.2), [simple], {colorful}, <lora:thing:0.8>, \\(artist\\)",
+    "1234567890 3.14159 2024-05-01 16:9 1920x1080 #ff00ff 100%",
+    "日本語のテキスト, 中文提示词, 한국어, Ελληνικά, русский текст, naïve café résumé, ＦＵＬＬＷＩＤＴＨ",
+    "emoji 🐲🔥✨ and symbols ™ © ½ → ≥ …",
+    "UPPERCASE and MiXeD CaSe words, camelCaseWord snake_case_word kebab-case-word",
+    "   leading and trailing spaces   ",
+    "quotes \"double\" 'single' `backtick` and ``weird'' ones",
+    "",
+]  # fmt: skip
+
+
+def _conversion_dir(root, spec_id):
+    # library versions are part of the key, a conversion is only trusted for the versions it was checked with
+    key = f"{spec_id}|{transformers.__version__}|{tokenizers.__version__}"
+    return os.path.join(root, hashlib.blake2b(key.encode("utf-8"), digest_size=8).hexdigest())
+
+
+def check_parity(slow, fast, texts=PARITY_TEXTS):
+    """
+    Returns None if fast gives the same ids as slow for every text (with and without special tokens),
+    otherwise the first text that differs.
+    """
+    if slow.num_special_tokens_to_add() != fast.num_special_tokens_to_add():
+        return "<num_special_tokens_to_add>"
+    for add_special_tokens in (False, True):
+        fast_ids = fast(list(texts), add_special_tokens=add_special_tokens)["input_ids"]
+        for text, ids in zip(texts, fast_ids):
+            if slow(text, add_special_tokens=add_special_tokens)["input_ids"] != ids:
+                return text
+    return None
+
+
+def load_converted(root, spec_id):
+    """
+    Loads the converted tokenizer of an earlier run from root.
+    Returns (tokenizer, True) if it passed the parity check, (None, False) if it failed it
+    and (None, None) if there is none.
+    """
+    path = _conversion_dir(root, spec_id)
+    try:
+        with open(os.path.join(path, "conversion.json"), "r", encoding="utf-8") as f:
+            info = json.load(f)
+        if not info.get("parity"):
+            return None, False
+        tok = PreTrainedTokenizerFast(tokenizer_file=os.path.join(path, "tokenizer.json"), **info["special_tokens"])
+        return tok, True
+    except FileNotFoundError:
+        return None, None
+    except Exception as e:
+        ryuu_log(f"Could not load converted tokenizer from {path}: {e}", loglevel="warning")
+        return None, None
+
+
+def convert_to_fast(slow, root=None, spec_id=None):
+    """
+    Builds a fast (Rust) tokenizer from a slow one. Returns it if it gives the same ids on PARITY_TEXTS, otherwise None.
+    With root given the tokenizer.json and the parity result are stored,
+    so the next start doesn't need to load the slow one at all.
+    """
+    special_tokens = {name: str(token) for name, token in slow.special_tokens_map.items() if isinstance(token, str)}
+    try:
+        fast = PreTrainedTokenizerFast(tokenizer_object=convert_slow_tokenizer(slow), **special_tokens)
+        mismatch = check_parity(slow, fast)
+    except Exception as e:
+        ryuu_log(f"Could not convert {type(slow).__name__} to a fast tokenizer: {e}", loglevel="warning")
+        return None
+
+    if root and spec_id:
+        path = _conversion_dir(root, spec_id)
+        try:
+            os.makedirs(path, exist_ok=True)
+            if mismatch is None:
+                fast.backend_tokenizer.save(os.path.join(path, "tokenizer.json"))
+            with open(os.path.join(path, "conversion.json"), "w", encoding="utf-8") as f:
+                json.dump({"spec": spec_id, "parity": mismatch is None, "special_tokens": special_tokens}, f, indent=2)
+        except OSError as e:
+            ryuu_log(f"Could not store converted tokenizer in {path}: {e}", loglevel="warning")
+
+    if mismatch is not None:
+        ryuu_log(f"Keeping slow {type(slow).__name__}, converted one differs on {mismatch!r}", loglevel="debug")
+        return None
+    return fast
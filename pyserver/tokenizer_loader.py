@@ -0,0 +1,394 @@
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import transformers
+from transformers import AutoTokenizer, CLIPTokenizer, PreTrainedTokenizerBase, T5Tokenizer, T5TokenizerFast
+
+from ..modules.shared.ryuu_log import ryuu_log
+from .tokenizer_conversion import convert_to_fast, load_converted
+
+# key: (tokenizer class, repo id, from_pretrained kwargs, log name)
+_TOKENIZER_SPECS = {
+    # CLIP-L | SDXL, FLUX (2nd), SD3(.5), etc
+    # NOTE: CLIP-L Fast tokenizer is NOT faster
+    # NOTE: Jina clip probably same as this (or clip G)
+    "clip_l": (CLIPTokenizer, "openai/clip-vit-large-patch14", {}, "CLIP-L"),
+    # CLIP-G tok is practically almost exact same as CLIP-L tok
+    # not important but, CLIP-G (pretty sure it just has '!' as padding token over L) https://huggingface.co/stabilityai/stable-diffusion-xl-base-1.0/tree/main/tokenizer_2
+    # "clip_g": (CLIPTokenizer, "stabilityai/stable-diffusion-xl-base-1.0", {"subfolder": "tokenizer_2"}, "CLIP-G"),
+    #
+    # NOTE: below are LLM tokenizers, most output same or very similar token counts but they are NOT the same
+    # T5-XXL | Chroma, Flux (1st), SD3(.5), etc
+    # NOTE: BFL flux dev is also possible, but they should all do the same thing because same spiece.model file iirc
+    "t5": (T5Tokenizer, "google/t5-v1_1-xxl", {"legacy": False}, "T5"),
+    # T5-XXL | Faster | Flux (1st), SD3(.5), etc
+    # legacy=False shouldnt impact anything, ref: https://github.com/huggingface/transformers/pull/24565
+    "t5_fast": (T5TokenizerFast, "google/t5-v1_1-xxl", {"legacy": False}, "T5-Fast"),
+    # umt5-XXL | WAN 2.1
+    "umt5": (AutoTokenizer, "google/umt5-xxl", {}, "UMT5"),
+    # Gemma 2 2B | Lumina Image 2.0
+    "gemma2": (AutoTokenizer, "unsloth/gemma-2-2b", {}, "Gemma2"),
+    # Gemma 3 1B/4B | *Custom* | NOTE: VERY similar to G2 but not same.
+    "gemma3": (AutoTokenizer, "unsloth/gemma-3-1b-it", {}, "Gemma3"),
+    # LLaMA 3.1 8B | hidream, hunyuan video, etc
+    "llama3": (AutoTokenizer, "unsloth/Meta-Llama-3.1-8B-Instruct", {}, "LLaMA3"),
+    # Qwen 2.5 VL | OmnigenV2
+    "qwen25vl": (AutoTokenizer, "Qwen/Qwen2.5-VL-3B-Instruct", {}, "Qwen2.5VL"),
+    # Pile T5 me thinks | AuraFlow/PonyFlow (Pony v7)
+    "auraflow": (AutoTokenizer, "fal/AuraFlow", {"subfolder": "tokenizer"}, "AuraFlow"),
+}
+
+_ALIASES = {"qwen2.5vl": "qwen25vl"}
+
+# token estimate family per key, only set for tokenizers added through the config file
+_TOKENIZER_FAMILIES = {}
+
+
+def _user_data_dir():
+    # RYUU_DATA_DIR is mostly for the standalone token count service, which runs without ComfyUI
+    if os.environ.get("RYUU_DATA_DIR"):
+        return os.environ["RYUU_DATA_DIR"]
+    try:
+        import folder_paths  # type: ignore
+    except ImportError:
+        return None  # outside of ComfyUI, e.g. the scripts in extras/
+    return os.path.join(folder_paths.get_user_directory(), "ryuunoodles")
+
+
+def _parse_registry_entry(key, entry, config_dir, local_files_only):
+    """Turns one config entry into a spec, fields that aren't set are taken from the built-in spec of the same key."""
+    base_cls, base_repo, base_kwargs, base_name = _TOKENIZER_SPECS.get(key, (AutoTokenizer, None, {}, key))
+
+    tokenizer_cls = base_cls
+    if "class" in entry:
+        tokenizer_cls = getattr(transformers, str(entry["class"]), None)
+        # only tokenizer classes, the config shouldn't be able to instantiate arbitrary things
+        is_class = isinstance(tokenizer_cls, type)
+        if tokenizer_cls is not AutoTokenizer and not (is_class and issubclass(tokenizer_cls, PreTrainedTokenizerBase)):
+            raise ValueError(f"'{entry['class']}' is not a transformers tokenizer class")
+
+    repo_id = base_repo
+    if "path" in entry:
+        # local folder, relative paths are relative to the config file
+        repo_id = os.path.join(config_dir, os.path.expanduser(str(entry["path"])))
+    elif "repo" in entry:
+        repo_id = str(entry["repo"])
+    if not repo_id:
+        raise ValueError("needs a 'repo' or 'path'")
+
+    kwargs = dict(base_kwargs)
+    if repo_id != base_repo:
+        kwargs.pop("subfolder", None)  # belongs to the built-in repo
+    kwargs.update(entry.get("kwargs") or {})
+    if "subfolder" in entry:
+        kwargs["subfolder"] = entry["subfolder"]
+    if entry.get("local_files_only", local_files_only):
+        kwargs["local_files_only"] = True
+
+    return tokenizer_cls, repo_id, kwargs, entry.get("name", base_name)
+
+
+def load_registry(path):
+    """
+    Adds/overrides tokenizers from a JSON config file, e.g.
+    {
+        "local_files_only": true,
+        "tokenizers": {
+            "clip_l": {"path": "/models/text_encoders/clip_l_tokenizer"},
+            "mistral": {"repo": "mistralai/Mistral-7B-v0.1", "name": "Mistral", "family": "llama3", "aliases": ["m7b"]}
+        }
+    }
+    Entry fields: class (transformers tokenizer class, default AutoTokenizer), repo or path, subfolder, kwargs,
+    local_files_only (never touch the network, top level value is the default), name (for logs),
+    family (for estimates: clip, sentencepiece, gemma, llama3 or qwen) and aliases.
+    Broken entries are skipped with a warning. Returns the keys that were added or changed.
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            config = json.load(f)
+    except (OSError, ValueError) as e:
+        ryuu_log(f"Could not read tokenizer config {path}: {e}", loglevel="warning")
+        return []
+
+    config_dir = os.path.dirname(os.path.abspath(path))
+    local_files_only = bool(config.get("local_files_only", False))
+    changed = []
+    for raw_key, entry in (config.get("tokenizers") or {}).items():
+        key = raw_key.lower().strip()
+        try:
+            if not isinstance(entry, dict):
+                raise ValueError("entry has to be an object")
+            spec = _parse_registry_entry(key, entry, config_dir, local_files_only)
+        except Exception as e:
+            ryuu_log(f"Skipping tokenizer '{raw_key}' from {path}: {e}", loglevel="warning")
+            continue
+
+        _TOKENIZER_SPECS[key] = spec
+        if "family" in entry:
+            _TOKENIZER_FAMILIES[key] = str(entry["family"])
+        for alias in entry.get("aliases") or []:
+            _ALIASES[str(alias).lower().strip()] = key
+        changed.append(key)
+
+    # top level local_files_only applies to the built-in tokenizers that aren't in the config too
+    if local_files_only:
+        for key, (tokenizer_cls, repo_id, kwargs, log_name) in _TOKENIZER_SPECS.items():
+            if key not in changed:
+                _TOKENIZER_SPECS[key] = (tokenizer_cls, repo_id, {**kwargs, "local_files_only": True}, log_name)
+
+    if changed:
+        ryuu_log(f"Loaded tokenizer config {path}: {', '.join(changed)}", loglevel="debug")
+    return changed
+
+
+def get_tokenizer_family(name):
+    """Estimate family set in the config file for name, None for built-in tokenizers."""
+    return _TOKENIZER_FAMILIES.get(resolve_key(name))
+
+
+# Tokenizers can be added or pointed at local files with a JSON file (see load_registry)
+# RYUU_TOKENIZER_CONFIG can point somewhere else, default is ryuunoodles/tokenizers.json in ComfyUI's user directory
+# where config, caches and snapshots live, None if there's no ComfyUI user directory (and no RYUU_DATA_DIR)
+DATA_DIR = _user_data_dir()
+_config_path = os.environ.get("RYUU_TOKENIZER_CONFIG", "") or (DATA_DIR and os.path.join(DATA_DIR, "tokenizers.json"))
+if _config_path and os.path.isfile(_config_path):
+    load_registry(_config_path)
+
+# every key get_tokenizer() knows about (aliases excluded)
+TOKENIZER_KEYS = tuple(_TOKENIZER_SPECS)
+
+# Slow (python) tokenizers are converted to fast ones if they give the same ids, see tokenizer_conversion.py
+# The converted tokenizer.json is kept in the user directory so later starts skip loading the slow one. "off" disables
+FAST_CONVERSION = os.environ.get("RYUU_TOKENIZER_FAST_CONVERT", "").lower() != "off"
+_conversion_root = DATA_DIR and os.path.join(DATA_DIR, "fast_tokenizers")
+
+# Max estimated memory of all loaded tokenizers in MB, least recently used ones are dropped above it. 0 = no limit
+MEMORY_BUDGET = int(float(os.environ.get("RYUU_TOKENIZER_MEMORY_BUDGET_MB", "") or 0) * 1024 * 1024)
+
+# Lazy tokenizer loader and cache
+# Keyed by spec id instead of name, so keys that load the exact same thing share one instance. Kept in LRU order
+_tokenizer_cache = OrderedDict()
+_tokenizer_memory = {}  # spec id -> estimated bytes
+_cache_lock = threading.Lock()
+# one lock per spec id, used for loading and encoding since HF tokenizers aren't safe to share across threads
+_tokenizer_locks = {}
+_tokenizer_locks_guard = threading.Lock()
+# load state per spec id for the status route: "loading", "loaded" or "failed" plus load time/memory/error
+_tokenizer_status = {}
+# spec ids a load_in_background() thread is running for
+_background_loads = set()
+
+
+def load_and_log(tokenizer_cls, *args, log_name=None, **kwargs):
+    if log_name:
+        ryuu_log(f"Loading {log_name} tokenizer...", loglevel="debug")
+        # Force the log to be displayed immediately
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+    tok = tokenizer_cls.from_pretrained(*args, **kwargs)
+    if log_name:
+        ryuu_log(f"Loaded {log_name} tokenizer.", loglevel="debug")
+    return tok
+
+
+def _load_tokenizer(spec_id, tokenizer_cls, repo_id, kwargs, log_name):
+    """Loads a tokenizer, slow ones are replaced by a converted fast one if that passed the parity check."""
+    if not FAST_CONVERSION:
+        return load_and_log(tokenizer_cls, repo_id, log_name=log_name, **kwargs), False
+
+    if _conversion_root:
+        tok, parity = load_converted(_conversion_root, spec_id)
+        if tok is not None:
+            ryuu_log(f"Loaded {log_name} tokenizer (converted to fast).", loglevel="debug")
+            return tok, True
+    else:
+        parity = None
+
+    tok = load_and_log(tokenizer_cls, repo_id, log_name=log_name, **kwargs)
+    # parity False: converted before and it didn't match, no point doing it again
+    if getattr(tok, "is_fast", False) or parity is False:
+        return tok, False
+    fast = convert_to_fast(tok, _conversion_root, spec_id)
+    return (fast, True) if fast is not None else (tok, False)
+
+
+def resolve_key(name):
+    key = name.lower().strip()
+    return _ALIASES.get(key, key)
+
+
+def _spec_id(key):
+    spec = _TOKENIZER_SPECS.get(key)
+    if spec is None:
+        return key
+    tokenizer_cls, repo_id, kwargs, _ = spec
+    return f"{tokenizer_cls.__name__}|{repo_id}|{sorted(kwargs.items())}"
+
+
+def get_tokenizer_lock(name):
+    spec_id = _spec_id(resolve_key(name))
+    with _tokenizer_locks_guard:
+        lock = _tokenizer_locks.get(spec_id)
+        if lock is None:
+            lock = _tokenizer_locks[spec_id] = threading.RLock()
+        return lock
+
+
+def get_tokenizer(name):
+    key = resolve_key(name)
+    if key not in _TOKENIZER_SPECS:
+        return None
+    spec_id = _spec_id(key)
+
+    with _cache_lock:
+        tok = _tokenizer_cache.get(spec_id)
+        if tok is not None:
+            _tokenizer_cache.move_to_end(spec_id)
+            return tok
+
+    # lock per spec so concurrent requests for a cold tokenizer only load it once
+    with get_tokenizer_lock(key):
+        with _cache_lock:
+            tok = _tokenizer_cache.get(spec_id)
+        if tok is not None:
+            return tok
+
+        tokenizer_cls, repo_id, kwargs, log_name = _TOKENIZER_SPECS[key]
+        _tokenizer_status[spec_id] = {"state": "loading", "started": time.time()}
+        start = time.perf_counter()
+        try:
+            tok, converted = _load_tokenizer(spec_id, tokenizer_cls, repo_id, kwargs, log_name)
+        except Exception as e:
+            _tokenizer_status[spec_id] = {"state": "failed", "error": str(e)}
+            raise
+
+        memory = estimate_tokenizer_memory(tok)
+        _tokenizer_status[spec_id] = {
+            "state": "loaded",
+            "load_time": time.perf_counter() - start,
+            "memory_bytes": memory,
+            "converted_to_fast": converted,
+        }
+        with _cache_lock:
+            _tokenizer_cache[spec_id] = tok
+            _tokenizer_memory[spec_id] = memory or 0
+            _evict_over_budget(keep=spec_id)
+        return tok
+
+
+def is_tokenizer_loaded(name):
+    """True if get_tokenizer(name) would return right away (unknown names included, they're just None)."""
+    key = resolve_key(name)
+    if key not in _TOKENIZER_SPECS:
+        return True
+    with _cache_lock:
+        return _spec_id(key) in _tokenizer_cache
+
+
+def is_tokenizer_failed(name):
+    return _tokenizer_status.get(_spec_id(resolve_key(name)), {}).get("state") == "failed"
+
+
+def _evict_over_budget(keep):
+    """Drops least recently used tokenizers until the estimate fits the budget. Needs _cache_lock."""
+    if not MEMORY_BUDGET:
+        return
+    for spec_id in list(_tokenizer_cache):
+        if sum(_tokenizer_memory.values()) <= MEMORY_BUDGET:
+            break
+        if spec_id == keep:
+            continue
+        # anyone still holding a reference keeps using it, it's just not cached anymore
+        del _tokenizer_cache[spec_id]
+        _tokenizer_memory.pop(spec_id, None)
+        _tokenizer_status.pop(spec_id, None)
+        ryuu_log(f"Evicted tokenizer {spec_id} to stay within the memory budget.", loglevel="debug")
+
+
+def get_tokenizer_status():
+    """Status of every known tokenizer key, keys sharing an instance share the status too."""
+    status = {}
+    for key in TOKENIZER_KEYS:
+        status[key] = dict(_tokenizer_status.get(_spec_id(key), {"state": "not_loaded"}))
+    return status
+
+
+def get_tokenizer_aliases():
+    """{alias: key} for the names get_tokenizer_status() doesn't list itself (e.g. qwen2.5vl -> qwen25vl)"""
+    return dict(_ALIASES)
+
+
+def get_memory_usage():
+    with _cache_lock:
+        return {"used_bytes": sum(_tokenizer_memory.values()), "budget_bytes": MEMORY_BUDGET or None}
+
+
+def estimate_tokenizer_memory(tokenizer):
+    """
+    Rough estimate of the memory a tokenizer holds in bytes.
+    Uses the serialized size of the vocab/model, real usage is a small multiple of that but it's good for comparing.
+    """
+    try:
+        if getattr(tokenizer, "is_fast", False):
+            return len(tokenizer.backend_tokenizer.to_str())
+        sp_model = getattr(tokenizer, "sp_model", None)
+        if sp_model is not None:
+            return len(sp_model.serialized_model_proto())
+        # slow BPE tokenizers (CLIP) keep the vocab and merges in plain dicts
+        size = 0
+        for table in (getattr(tokenizer, "encoder", None), getattr(tokenizer, "bpe_ranks", None)):
+            if table:
+                size += sum(len(str(k)) + 8 for k in table)
+        return size or None
+    except Exception:
+        return None
+
+
+def _warmup(keys):
+    for key in keys:
+        try:
+            get_tokenizer(key)
+        except Exception as e:
+            ryuu_log(f"Tokenizer warm-up for '{key}' failed: {e}", loglevel="warning")
+
+
+def load_in_background(name):
+    """Starts loading a tokenizer on its own thread, unless it's already loaded or being loaded that way."""
+    key = resolve_key(name)
+    if key not in _TOKENIZER_SPECS:
+        return
+    spec_id = _spec_id(key)
+    with _cache_lock:
+        if spec_id in _tokenizer_cache or spec_id in _background_loads:
+            return
+        _background_loads.add(spec_id)
+
+    def load():
+        try:
+            _warmup([key])
+        finally:
+            with _cache_lock:
+                _background_loads.discard(spec_id)
+
+    threading.Thread(target=load, name=f"ryuu_tokenizer_load_{key}", daemon=True).start()
+
+
+def start_warmup():
+    """
+    Loads the tokenizers listed in RYUU_TOKENIZER_WARMUP (comma separated, e.g. 'clip_l,t5_fast')
+    on a background thread so the first token count after a restart doesn't have to wait for them.
+    Off by default, so nothing is loaded/downloaded on startup for people who never use the counter.
+    """
+    raw = os.environ.get("RYUU_TOKENIZER_WARMUP", "")
+    keys = [key.strip().lower() for key in raw.split(",") if key.strip()]
+    if not keys or keys == ["off"]:
+        return []
+
+    thread = threading.Thread(target=_warmup, args=(keys,), name="ryuu_tokenizer_warmup", daemon=True)
+    thread.start()
+    return keys